@@ -0,0 +1 @@
+"""Benchmarks of instatools, run as python -m benchmarks.<name>"""
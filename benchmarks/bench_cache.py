@@ -0,0 +1,64 @@
+"""
+Cost of a lookup in the replay cache of recorded responses versus the
+number of recorded urls: the index of DataBaseCache, versus loading the
+table and scanning it for a url prefix (as the cache used to). Usage:
+
+    python -m benchmarks.bench_cache [lookups] [sizes...]
+"""
+from tempfile import TemporaryDirectory
+from time import monotonic
+import os
+import sqlite3
+import sys
+
+from instatools.cache import DataBaseCache
+
+URL = 'https://i.instagram.com/api/v1/feed/tag/tag%d/?max_id=%d'
+VALUE = b'x' * 2048
+
+
+def legacy(path):
+    cache = {}
+    for key, value in sqlite3.connect(path).execute('select * from cache'):
+        cache.setdefault(key, []).append(value)
+
+    def get(key):
+        if key in cache:
+            return cache[key][0]
+        for k in cache:
+            if k.startswith(key):
+                return cache[k][0]
+    return get
+
+
+def indexed(path):
+    return DataBaseCache(path).get
+
+
+def main(n_lookups=2000, sizes=(1000, 10000, 100000)):
+    print('%8s %10s %12s %14s' % ('urls', 'lookup', 'load ms', 'us/lookup'))
+    for size in sizes:
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'instagram_cache.db')
+            with sqlite3.connect(path) as db:
+                db.execute('create table cache(key, value)')
+                db.executemany('insert into cache values (?, ?)', (
+                    (URL % (i, i), VALUE) for i in range(size)))
+            # prefixes of urls spread over the table, each looked up once
+            keys = [(URL % (i, i))[:-3]
+                    for i in range(0, size, max(1, size // n_lookups))]
+            for name, load in [('scan', legacy), ('index', indexed)]:
+                start = monotonic()
+                get = load(path)
+                loaded = monotonic() - start
+                start = monotonic()
+                for key in keys:
+                    assert get(key) is not None
+                elapsed = monotonic() - start
+                print('%8d %10s %12.1f %14.1f' % (
+                    size, name, loaded * 1000, elapsed / len(keys) * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         [int(a) for a in sys.argv[2:]] or (1000, 10000, 100000))
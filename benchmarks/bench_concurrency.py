@@ -0,0 +1,74 @@
+"""
+Request throughput of one shared Session versus number of worker threads.
+
+Runs against a local stub server that answers every request after a fixed
+latency, so the numbers show how much of that latency concurrent requests
+manage to overlap. Usage:
+
+    python -m benchmarks.bench_concurrency [requests] [latency_ms]
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+from time import monotonic, sleep
+import sys
+
+from instatools.session import Session
+
+BODY = b'{"status": "ok"}'
+LATENCY = 0.02
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        sleep(LATENCY)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def run(url, n_requests, n_threads):
+    session = Session('usr', 'pwd', pool_maxsize=n_threads,
+                      max_in_flight=n_threads)
+    start = monotonic()
+    with ThreadPoolExecutor(n_threads) as pool:
+        for _ in pool.map(lambda _: session.request('GET', url),
+                          range(n_requests)):
+            pass
+    return n_requests / (monotonic() - start)
+
+
+def main(n_requests=200, latency_ms=20):
+    global LATENCY
+    LATENCY = latency_ms / 1000
+    server = Server(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+    print('%d requests, %dms server latency' % (n_requests, latency_ms))
+    print('%8s %12s %8s' % ('threads', 'requests/s', 'speedup'))
+    base = None
+    for n_threads in [1, 2, 4, 8, 16, 32]:
+        rate = run(url, n_requests, n_threads)
+        base = base or rate
+        print('%8d %12.1f %7.1fx' % (n_threads, rate, rate / base))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
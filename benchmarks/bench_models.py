@@ -0,0 +1,76 @@
+"""
+Memory held by parsed users and posts, with regular and compact models.
+
+Parses synthetic follower and post json the size of what the api returns,
+then measures the memory still allocated once the json itself is no longer
+referenced, as after a page of a feed has been parsed. Usage:
+
+    python -m benchmarks.bench_models [items]
+"""
+from time import monotonic
+import sys
+import tracemalloc
+
+from instatools.instagram import Instagram
+from instatools.models import ModelFactory
+
+
+def make_user(pk):
+    return {'pk': pk, 'username': 'user_%d' % pk,
+            'full_name': 'User %d' % pk, 'is_private': pk % 2 == 0,
+            'profile_pic_url': 'https://scontent.cdninstagram.com/t51.2885-19'
+                               '/s150x150/%d_n.jpg' % pk,
+            'profile_pic_id': '%d_%d' % (pk * 7, pk),
+            'is_verified': False, 'has_anonymous_profile_picture': False,
+            'latest_reel_media': 0, 'is_favorite': False}
+
+
+def make_post(pk):
+    candidates = [{'width': w, 'height': w,
+                   'url': 'https://scontent.cdninstagram.com/%d_%d.jpg' % (
+                       pk, w)} for w in (1080, 640, 320, 150)]
+    return {'pk': pk, 'id': '%d_%d' % (pk, pk % 1000), 'code': 'B%dx' % pk,
+            'taken_at': 1500000000 + pk, 'device_timestamp': pk * 1000,
+            'media_type': 1, 'client_cache_key': 'key%d' % pk,
+            'filter_type': 0, 'comment_likes_enabled': True,
+            'comment_threading_enabled': True, 'has_more_comments': False,
+            'max_num_visible_preview_comments': 2, 'preview_comments': [],
+            'can_view_more_preview_comments': False, 'comment_count': pk % 50,
+            'image_versions2': {'candidates': candidates},
+            'original_width': 1080, 'original_height': 1080,
+            'user': make_user(pk % 5000), 'caption': {'text': 'caption'},
+            'like_count': pk % 500, 'has_liked': False,
+            'photo_of_you': False, 'caption_is_edited': False,
+            'organic_tracking_token': 'token%d' % pk}
+
+
+def measure(api, model, make, n_items):
+    items = [make(pk) for pk in range(n_items)]
+    start = monotonic()
+    model.parse_list(api, items)
+    elapsed = monotonic() - start
+
+    tracemalloc.start()
+    parsed = model.parse_list(api, [make(pk) for pk in range(n_items)])
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del parsed
+    return size, elapsed
+
+
+def main(n_items=20000):
+    modes = [('regular', ModelFactory),
+             ('compact', ModelFactory.compact()),
+             ('compact+raw', ModelFactory.compact(keep_raw=True))]
+    print('%d items per model' % n_items)
+    print('%6s %12s %12s %10s' % ('model', 'mode', 'bytes/item', 'parse ms'))
+    for kind, make in [('user', make_user), ('post', make_post)]:
+        for mode, models in modes:
+            api = Instagram('usr', 'pwd', models=models)
+            size, elapsed = measure(api, getattr(models, kind), make, n_items)
+            print('%6s %12s %12.0f %10.1f' % (
+                kind, mode, size / n_items, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
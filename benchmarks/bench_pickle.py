@@ -0,0 +1,54 @@
+"""
+Size and speed of snapshots of parsed posts, pickled one by one with
+pickle.dumps or as a batch with models.dumps (nested users stored once per
+id). Posts are pickled after their fields were used, as in a real job.
+Usage:
+
+    python -m benchmarks.bench_pickle [items] [users]
+"""
+from time import monotonic
+import pickle
+import sys
+
+from benchmarks.bench_models import make_post, make_user
+from instatools import models
+from instatools.instagram import Instagram
+from instatools.models import ModelFactory
+
+
+def parse(api, n_items, n_users):
+    posts = api.models.post.parse_list(api, [
+        dict(make_post(pk), user=make_user(pk % n_users))
+        for pk in range(n_items)])
+    for post in posts:
+        post.likes, post.user.username, post.image_versions
+    return posts
+
+
+def measure(dumps, loads, posts):
+    start = monotonic()
+    data = dumps(posts)
+    dumped = monotonic() - start
+    start = monotonic()
+    loads(data)
+    return len(data), dumped, monotonic() - start
+
+
+def main(n_items=20000, n_users=500):
+    print('%d posts by %d users' % (n_items, n_users))
+    print('%12s %14s %12s %10s %10s' % (
+        'mode', 'snapshot', 'bytes/item', 'dump ms', 'load ms'))
+    for mode, factory in [('regular', ModelFactory),
+                          ('compact', ModelFactory.compact())]:
+        api = Instagram('usr', 'pwd', models=factory)
+        for name, dumps, loads in [
+                ('pickle.dumps', pickle.dumps, pickle.loads),
+                ('models.dumps', models.dumps, models.loads)]:
+            size, dumped, loaded = measure(
+                dumps, loads, parse(api, n_items, n_users))
+            print('%12s %14s %12.0f %10.1f %10.1f' % (
+                mode, name, size / n_items, dumped * 1000, loaded * 1000))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,50 @@
+"""
+Per-item cost of dropping old posts from large feed pages: parsing every
+post and checking its age with datetime (as FeedReader used to), versus
+the max_age watermark on raw taken_at values before parsing. Usage:
+
+    python -m benchmarks.bench_recency [items] [recent fraction]
+"""
+from datetime import datetime
+from time import monotonic, time
+import sys
+
+from benchmarks.bench_models import make_post
+from instatools.instagram import Instagram
+
+DAY = 86400
+
+
+def legacy(api, items, max_age):
+    def age_of(item):
+        created = datetime.fromtimestamp(item.taken_at)
+        return (datetime.now() - created).total_seconds()
+    posts = api.models.post.parse_list(api, items)
+    return [post for post in posts if age_of(post) <= max_age]
+
+
+def raw_filter(api, items, max_age):
+    pages = api.api_method().feed('tag_feed', 'beach', max_age=max_age)
+    pages._response = {'items': items, 'more_available': False}
+    pages._items = pages._page_data()
+    return pages.items
+
+
+def main(n_items=100000, recent=0.1):
+    api = Instagram('usr', 'pwd')
+    now = time()
+    items = [dict(make_post(pk), taken_at=int(
+        now - (DAY / 2 if pk < n_items * recent else 3 * DAY)))
+        for pk in range(n_items)]
+    print('%d posts, %d%% taken in the last day' % (n_items, recent * 100))
+    print('%12s %8s %10s' % ('filter', 'kept', 'ns/item'))
+    for name, run in [('parse+age', legacy), ('raw max_age', raw_filter)]:
+        start = monotonic()
+        kept = run(api, items, DAY)
+        elapsed = monotonic() - start
+        print('%12s %8d %10.0f' % (name, len(kept), elapsed / n_items * 1e9))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 0.1)
@@ -0,0 +1,192 @@
+"""
+Run many Instagram accounts at once from a pool of worker processes
+"""
+from concurrent.futures import Future
+from itertools import count, islice
+from threading import Lock, Thread
+from time import monotonic
+import multiprocessing
+import pickle
+import queue
+
+from .instagram import Instagram
+
+
+class AccountError(Exception):
+    """Raised for a job that failed inside an account worker"""
+
+
+class AccountPool:
+    """
+    Shards accounts across worker processes. Every account gets its own
+    Instagram (and so its own Session and rate limiters) in the worker that
+    owns it, and runs its jobs in its own thread there, so one account
+    waiting for its rate limits does not hold up the others.
+
+    Jobs are Instagram method names (e.g. 'follow', 'like', 'comment',
+    'get_user') or 'feed' to read a feed with ApiMethod.feed:
+
+        with AccountPool({'user1': 'pwd1', 'user2': 'pwd2'}) as pool:
+            pool.submit('user1', 'follow', user_id)
+            posts = pool.submit('user2', 'feed', 'tag_feed', 'beach',
+                                limit=100).result()
+    """
+    def __init__(self, accounts, processes=None, login=True, context=None,
+                 **session_options):
+        """
+        :param accounts: dict: username -> password, or -> session data
+        :param processes: int: number of worker processes (default cpus)
+        :param login: bool: log accounts in when their worker starts
+        :param context: str: multiprocessing start method
+        :param session_options: passed to every account's Session
+        """
+        ctx = multiprocessing.get_context(context)
+        processes = min(processes or ctx.cpu_count(), len(accounts)) or 1
+
+        self._futures = {}
+        self._job_ids = count()
+        self._lock = Lock()
+        self._results = ctx.Queue()
+        self._started = monotonic()
+        self._stats = {name: {'queued': 0, 'done': 0, 'failed': 0,
+                              'limits': {}} for name in accounts}
+
+        shards = [{} for _ in range(processes)]
+        self.shards = {}
+        for i, (name, credentials) in enumerate(accounts.items()):
+            shards[i % processes][name] = credentials
+            self.shards[name] = i % processes
+
+        self._jobs = [ctx.Queue() for _ in range(processes)]
+        self._workers = [
+            ctx.Process(target=_worker, daemon=True, args=(
+                shard, jobs, self._results, login, session_options))
+            for shard, jobs in zip(shards, self._jobs)]
+        for worker in self._workers:
+            worker.start()
+
+        self._collector = Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, account, method, *args, **kwargs):
+        """
+        Queue a job for an account
+        :param account: str: username of the account to run the job as
+        :param method: str: Instagram method name, or 'feed'
+        :param args: arguments of the method
+        :param kwargs: keyword arguments of the method
+        :return: Future: resolves to the result of the job
+        """
+        if account not in self.shards:
+            raise ValueError('Unknown account: %s' % account)
+        future = Future()
+        with self._lock:
+            job_id = next(self._job_ids)
+            self._futures[job_id] = future
+            self._stats[account]['queued'] += 1
+        self._jobs[self.shards[account]].put(
+            (job_id, account, method, args, kwargs))
+        return future
+
+    def map(self, method, jobs):
+        """Submit (account, args) pairs for one method, return the futures"""
+        return [self.submit(account, method, *args) for account, args in jobs]
+
+    def stats(self):
+        """
+        Per account queue depth, completed and failed jobs, throughput
+        (jobs per minute since the pool started) and remaining rate limit
+        tokens of each endpoint class
+        """
+        minutes = max(monotonic() - self._started, 1e-9) / 60
+        with self._lock:
+            return {name: dict(stats, limits=dict(stats['limits']),
+                               per_minute=stats['done'] / minutes)
+                    for name, stats in self._stats.items()}
+
+    def close(self):
+        """Finish queued jobs and stop the workers"""
+        for jobs in self._jobs:
+            jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._results.put(None)
+        self._collector.join()
+
+    def _collect(self):
+        for data in iter(self._results.get, None):
+            job_id, account, error, result, limits = pickle.loads(data)
+            with self._lock:
+                future = self._futures.pop(job_id)
+                stats = self._stats[account]
+                stats['queued'] -= 1
+                stats['failed' if error else 'done'] += 1
+                stats['limits'] = limits
+            if error:
+                future.set_exception(AccountError(result))
+            else:
+                future.set_result(result)
+
+
+def _worker(accounts, jobs, results, login, session_options):
+    """Process owning a shard of accounts, one thread per account"""
+    threads = {}
+    for name, credentials in accounts.items():
+        account_jobs = queue.Queue()
+        threads[name] = (account_jobs, Thread(
+            target=_account_worker, daemon=True,
+            args=(name, credentials, account_jobs, results, login,
+                  session_options)))
+        threads[name][1].start()
+
+    for job in iter(jobs.get, None):
+        threads[job[1]][0].put(job)
+
+    for account_jobs, thread in threads.values():
+        account_jobs.put(None)
+        thread.join()
+
+
+def _account_worker(name, credentials, jobs, results, login,
+                    session_options):
+    api, failure = None, None
+    try:
+        if isinstance(credentials, dict):
+            api = Instagram(session=credentials, **session_options)
+        else:
+            api = Instagram(name, credentials, **session_options)
+        if login and not api.logged_in and not api.login():
+            failure = 'Login failed'
+    except Exception as e:
+        failure = 'Account could not be set up: %r' % e
+
+    # Jobs of an account that could not be set up fail instead of waiting
+    for job_id, account, method, args, kwargs in iter(jobs.get, None):
+        if failure:
+            result, error = failure, True
+        else:
+            try:
+                result, error = _run(api, method, args, kwargs), False
+            except Exception as e:
+                result, error = repr(e), True
+        limits = {} if api is None else {
+            limit: bucket.tokens
+            for limit, bucket in api.session.limits.items()}
+        try:
+            data = pickle.dumps((job_id, account, error, result, limits))
+        except Exception as e:  # result could not be pickled
+            data = pickle.dumps((job_id, account, True, repr(e), limits))
+        results.put(data)
+
+
+def _run(api, method, args, kwargs):
+    if method == 'feed':
+        limit = kwargs.pop('limit', None)
+        return list(islice(api.api_method().feed(*args, **kwargs), limit))
+    return getattr(api, method)(*args, **kwargs)
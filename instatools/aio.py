@@ -0,0 +1,519 @@
+"""
+Asyncio flavour of the Instagram api, so that a single event loop can drive
+thousands of feeds instead of parking one thread per feed.
+
+AsyncInstagram has the same methods as Instagram, but they return coroutines
+and feeds are iterated with `async for`. Paths, request signing, rate limits
+and model parsing are shared with the blocking api.
+Requires aiohttp: pip install instatools[async]
+"""
+from copy import deepcopy
+import asyncio
+import json
+
+import requests
+
+from .api import ApiMethod, _Pages, requires_login
+from .columns import Batch
+from .instagram.feeds import Feeds, FeedReader
+from .instagram.hub import Hub
+from .instagram.instagram import Instagram
+from .instagram.search import Search
+from .models import IdentityMap, ModelFactory
+from .session import BASE_URL, HEADERS, _make_logger, Session
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+
+# Result of a shared request that was cancelled before it got a response
+_abandoned = object()
+
+
+def _cookie_jar(cookies):
+    """Convert aiohttp response cookies to a requests cookie jar"""
+    jar = requests.cookies.RequestsCookieJar()
+    for morsel in cookies.values():
+        jar.set(morsel.key, morsel.value,
+                domain=morsel['domain'], path=morsel['path'] or '/')
+    return jar
+
+
+def _query(params):
+    """Query params as strings, dropping empty values like requests does"""
+    return {k: str(v) for k, v in (params or {}).items() if v is not None}
+
+
+class _Response:
+    """Fully read response with the parts of requests.Response used here"""
+    def __init__(self, resp, content):
+        self.content = content
+        self.cookies = _cookie_jar(resp.cookies)
+        self.headers = resp.headers
+        self.status_code = resp.status
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class AsyncRequestGate:
+    """Asyncio version of session.RequestGate"""
+    def __init__(self):
+        self._cond = None
+        self._active = 0
+        self._held = False
+
+    async def __aenter__(self):
+        async with self._condition():
+            await self._cond.wait_for(lambda: not self._held)
+            self._held = True
+            await self._cond.wait_for(lambda: not self._active)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self._cond:
+            self._held = False
+            self._cond.notify_all()
+
+    def passage(self):
+        """Async context for a single request"""
+        return _GatePassage(self)
+
+    def _condition(self):
+        # Created lazily so it belongs to the loop that runs the requests
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+
+class _GatePassage:
+    def __init__(self, gate):
+        self.gate = gate
+
+    async def __aenter__(self):
+        gate = self.gate
+        async with gate._condition():
+            await gate._cond.wait_for(lambda: not gate._held)
+            gate._active += 1
+
+    async def __aexit__(self, *exc_info):
+        gate = self.gate
+        async with gate._cond:
+            gate._active -= 1
+            if not gate._active:
+                gate._cond.notify_all()
+
+
+class AsyncSession(Session):
+    """
+    Session that makes requests with aiohttp, backing off and waiting for
+    rate limits with asyncio.sleep instead of blocking the thread
+    """
+    def __init__(self, username=None, password=None, session=None, *,
+                 pool_connections=100, max_in_flight=100, **options):
+        """
+        Takes the same options as Session, `pool_connections` limits the
+        total number of open connections
+        """
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for AsyncSession, '
+                              'install it with: pip install instatools[async]')
+        super().__init__(username, password, session,
+                         pool_connections=pool_connections,
+                         max_in_flight=max_in_flight, **options)
+
+    @property
+    def pool_stats(self):
+        return {}
+
+    async def close(self):
+        """Close the underlying aiohttp session and its connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def login(self):
+        """Login to Instagram with account credentials provided in __init__"""
+        if self.password is None:
+            self.logger.error('Password required for login')
+            return False
+
+        resp = await self.request('GET', self.url('login_challenge'),
+                                  endpoint='login_challenge',
+                                  return_json=False,
+                                  params=self._login_challenge_params())
+        if resp.status_code != 200:
+            self.logger.error('Requesting login challenge failed')
+            return False
+
+        self.logger.debug('Successfully requested login challenge url')
+        resp = await self.request('POST', self.url('login'),
+                                  endpoint='login', return_json=False,
+                                  data=self.login_data(resp.cookies))
+        return self._on_login(resp)
+
+    async def logout(self):
+        """Logout of currently logged-in account"""
+        resp = await self.request('GET', self.url('logout'),
+                                  endpoint='logout', return_json=False)
+        return self._on_logout(resp)
+
+    async def request(self, method, url, *, endpoint=None,
+                      params=None, data=None, return_json=True,
+                      headers=None, **kwargs):
+        """
+        Coroutine version of Session.request
+        :param method:
+        :param url:
+        :param endpoint:
+        :param params:
+        :param data:
+        :param return_json:
+        :param headers:
+        :param kwargs:
+        :return:
+        """
+        params, data = self.sign(method, url, params, data)
+        session = self._client()
+
+        await self.wait_limit(endpoint)
+        async with self._in_flight:
+            async with session.request(method, url, params=_query(params),
+                                       data=data, headers=headers,
+                                       proxy=self._proxy, **kwargs) as resp:
+                content = await resp.read()
+
+        if return_json:
+            return json.loads(content.decode('utf-8'))
+        return _Response(resp, content)
+
+    async def request_safely(self, *args, max_attempts=0, **kwargs):
+        """
+        Coroutine version of Session.request_safely
+        :param args:
+        :param max_attempts:
+        :param kwargs:
+        :return:
+        """
+        key = self._flight_key(args, kwargs)
+        if key is None:
+            return await self._request_safely(
+                *args, max_attempts=max_attempts, **kwargs)
+
+        while True:
+            flight, joined = self._join_flight(key, asyncio.Future)
+            if not joined:
+                break
+            # shielded, so that cancelling a waiter does not cancel the
+            # others; if the request it waits for is cancelled, it is made
+            # again by one of the waiters
+            resp = await asyncio.shield(flight)
+            if resp is not _abandoned:
+                return deepcopy(resp)
+        try:
+            resp = await self._request_safely(
+                *args, max_attempts=max_attempts, **kwargs)
+        except asyncio.CancelledError:
+            if self._land_flight(key, abandoned=True):
+                flight.set_result(_abandoned)
+            raise
+        except Exception as e:
+            if self._land_flight(key):
+                flight.set_exception(e)
+            raise
+        if self._land_flight(key):
+            flight.set_result(deepcopy(resp))
+        return resp
+
+    async def _request_safely(self, *args, max_attempts=0, **kwargs):
+        breaks_in_a_row = 0
+        fails = 0
+        sleep_time = self.sleep_on_page
+
+        while True:
+            try:
+                async with self.hold_requests.passage():
+                    resp = await self.request(*args, **kwargs)
+                return resp
+            except json.JSONDecodeError:
+                self.logger.error('Response not in JSON format: %s - %s',
+                                  args[0], args[1])
+            except Exception as e:
+                self.logger.error('Exception occurred - ' + repr(e)[:100])
+
+            fails += 1
+            if fails >= self.requests_to_break:
+                breaks_in_a_row += 1
+                await asyncio.sleep(self.sleep_on_break)
+                sleep_time = self.sleep_on_page
+            else:
+                await asyncio.sleep(sleep_time)
+                sleep_time *= self.exponential_sleep_increase
+
+            if breaks_in_a_row >= 5:
+                fails = 0
+                breaks_in_a_row = 0
+                await self.logout()
+                await asyncio.sleep(60)
+                await self.login()
+
+            if 0 < max_attempts < fails:
+                raise requests.ConnectionError(
+                    'After %d attempts failed to %s %s' % (
+                        max_attempts, args[0], args[1]
+                    ))
+
+    async def wait_limit(self, endpoint):
+        """
+        Await until the rate limit of the endpoint allows another request
+        :param endpoint: str: name of api path
+        :return:
+        """
+        reservation = self.reservation_for(endpoint)
+        if reservation is not None:
+            await reservation.wait_async()
+        if reservation is None or not reservation.take():
+            await self.limiter_for(endpoint).acquire_async()
+
+    def set_proxy(self, proxy):
+        """
+        Set proxy for all requests made with this session
+        :param proxy: str: proxy - format: "user:password@ip:port" OR "ip:port"
+        """
+        self._proxy = 'http://' + proxy
+
+    def _client(self):
+        # aiohttp sessions must be created inside the running event loop
+        if self._session is None:
+            self._in_flight = asyncio.Semaphore(self._max_in_flight)
+            self._session = aiohttp.ClientSession(
+                headers=HEADERS, connector=self._connector())
+            self._load_cookies(self._pending_cookies)
+        return self._session
+
+    def _connector(self):
+        options = self._pool_options
+        if self.keep_alive:
+            keep_alive = {'keepalive_timeout': options['idle_timeout']}
+        else:
+            keep_alive = {'force_close': True}
+        return aiohttp.TCPConnector(limit=options['pool_connections'],
+                                    limit_per_host=options['pool_maxsize'],
+                                    **keep_alive)
+
+    def _init_transport(self, max_in_flight):
+        self._max_in_flight = max_in_flight
+        self._in_flight = None
+        self.hold_requests = AsyncRequestGate()
+
+        self._session = None
+        self._pending_cookies = {}
+        self._proxy = None
+
+    def _load_cookies(self, cookies):
+        if self._session is None:
+            self._pending_cookies = dict(cookies or {})
+        else:
+            self._session.cookie_jar.update_cookies(
+                cookies, response_url=URL(BASE_URL))
+
+
+_done = object()
+
+
+class _AsyncPages(_Pages):
+    """Pages of a feed, iterated with `async for`"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending = iter(())
+
+    def __iter__(self):
+        raise TypeError('Feeds of AsyncInstagram are iterated with async for')
+
+    __next__ = __iter__
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = next(self._pending, _done)
+        while item is _done:
+            if not self.has_more:
+                raise StopAsyncIteration
+            await self.next()
+            self._pending = self._iter_new()
+            item = next(self._pending, _done)
+            if self._all_seen():
+                self._response[self._has_more_key] = False
+        return item
+
+    async def iter_batches(self, columns=None):
+        batch = self._batch(columns)
+        if batch:
+            yield batch
+        while self.has_more and not self._all_seen():
+            await self.next()
+            batch = self._batch(columns)
+            if batch:
+                yield batch
+
+    async def batch(self, columns=None):
+        result = Batch.parse(self._model, [], columns)
+        async for batch in self.iter_batches(columns):
+            result.extend(batch)
+        return result
+
+    async def prev(self):
+        self._items = await self._get_data('prev')
+        return self
+
+    async def next(self):
+        self._items = await self._get_data('next')
+        return self
+
+    async def _get_data(self, action):
+        await asyncio.sleep(self._page_delay())
+        self._response = await self.api.session.request_safely(
+            'GET', self._url, endpoint=self._feed_type,
+            params=self._page_params(action),
+            max_attempts=3)
+        return self._page_data()
+
+
+class AsyncApiMethod(ApiMethod):
+    """ApiMethod whose requests are coroutines"""
+
+    @requires_login
+    async def action(self, path, *args, max_attempts=10, return_key='',
+                     extra=None, method='POST', headers=None, params=None,
+                     data=None):
+        data = self._action_data(path, args, data)
+        resp = self._cached(path, args, params)
+        if resp is None:
+            self.api.logger.debug('Attempting to %s %s', path, *args)
+            resp = await self.api.session.request_safely(
+                method, self.api.session.url(path, *args), endpoint=path,
+                data=data, headers=headers,
+                params=params, max_attempts=max_attempts
+            )
+            self._cache(path, args, params, resp)
+        return self._handle_response(resp, return_key=return_key, extra=extra)
+
+    @requires_login
+    async def form(self, path, bodies, boundary, params=None, return_key=''):
+        body = self.api.session.build_form_body(bodies, boundary)
+        headers = self.api.session.form_headers(boundary)
+
+        resp = await self.api.session.request_safely(
+            'POST', self.api.session.url(path), endpoint=path,
+            params=params, data=body, headers=headers)
+
+        return self._handle_response(resp, return_key)
+
+    @staticmethod
+    def _pages(*args, **kwargs):
+        return _AsyncPages(*args, **kwargs)
+
+
+class AsyncFeedReader(FeedReader):
+    """FeedReader iterated with `async for`"""
+
+    def __iter__(self):
+        raise TypeError('Feeds of AsyncInstagram are iterated with async for')
+
+    __next__ = __iter__
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            try:
+                data = await self.feed.__anext__()
+
+            except StopAsyncIteration:
+                self._end_pass()
+                await asyncio.sleep(self.time_until_ready())
+                self.reset()
+
+            else:
+                self._track(data)
+                return data
+
+
+class AsyncInstagram(Instagram):
+    """
+    Instagram api whose methods are coroutines. Profile editing and
+    follower tracking (Instagram.followers/following) are not available
+    """
+
+    def __init__(self, username=None, password=None, session=None,
+                 models=ModelFactory, identity_ttl=None, response_cache=None,
+                 **session_options):
+        self.identity_map = IdentityMap(identity_ttl)
+        self.models = models
+        self.response_cache = response_cache
+        self.session = AsyncSession(username, password, session,
+                                    **session_options)
+        self.logger = _make_logger(self.username)
+        self.logged_in = session is not None
+
+        self.feeds = Feeds(api=self)
+        self.hub = Hub(api=self)
+        self.search = Search(api=self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.session.close()
+
+    def api_method(self):
+        return AsyncApiMethod(self)
+
+    def feed_reader(self, feed_type, *args, **kwargs):
+        return AsyncFeedReader(self, feed_type, *args, **kwargs)
+
+    async def login(self):
+        """Login to Instagram with account credentials provided in __init__"""
+        user = await self.session.login()
+        if user:
+            self.logged_in = True
+            return self.models.user.parse(self, user)
+        return False
+
+    async def logout(self):
+        """Logout of currently logged-in account"""
+        self.logged_in = not await self.session.logout()
+        return not self.logged_in
+
+    async def switch_user(self, username=None, password=None, session=None):
+        """Switches current account username and password - requires login"""
+        async with self.session.hold_requests:
+            if self.logged_in:
+                if not await self.logout():
+                    return False
+            self.session.switch_user(username, password, session)
+            user = await self.login()
+        return user
+
+    async def get_followers(self, user_id=None):
+        feed = self.api_method().feed('followers',
+                                      user_id or self.username_id)
+        return [user async for user in feed]
+
+    async def get_following(self, user_id=None):
+        feed = self.api_method().feed('following',
+                                      user_id or self.username_id)
+        return [user async for user in feed]
+
+    async def get_post(self, post_id):
+        posts = await self.api_method().action('post', post_id,
+                                               return_key='items')
+        return posts[0]
@@ -2,18 +2,20 @@
 Wrappers for interactions with Instagram API
 """
 from functools import wraps
-from time import sleep, monotonic as time
-from instatools.models import ModelFactory
+from instatools import stream
+from instatools.columns import Batch
+from time import sleep, monotonic as time, time as timestamp
 
 # todo logging
 max_seen_items = 1000000
+seen_store = 'bloom'
 sleep_between_pages = 0.5
+stream_chunk_size = 65536
 _feed_dict = {}
-_feed_dict.update({k: ModelFactory.comment
-                   for k in ['comments']})
-_feed_dict.update({k: ModelFactory.user
+_feed_dict.update({k: 'comment' for k in ['comments']})
+_feed_dict.update({k: 'user'
                    for k in ['user', 'following', 'followers', 'pending']})
-_feed_dict.update({k: ModelFactory.post
+_feed_dict.update({k: 'post'
                    for k in ['tag_feed', 'location_feed', 'user_feed',
                              'user_tags', 'timeline', 'liked', 'saved']})
 _ranked_feeds = ['tag_feed', 'user_feed', 'location_feed',
@@ -50,35 +52,63 @@ class ApiMethod:
         :param data:
         :return:
         """
-        data = data or {}
-        if 'friendship' in self.api.session.paths[path] and args:
-            data['user_id'] = args[0]
-        elif 'media' in self.api.session.paths[path] and args:
-            data['media_id'] = args[0]
-
-        self.api.logger.debug('Attempting to %s %s', path, *args)
-        resp = self.api.session.request_safely(
-            method, self.api.session.url(path, *args),
-            data=data, headers=headers,
-            params=params, max_attempts=max_attempts
-        )
+        data = self._action_data(path, args, data)
+        resp = self._cached(path, args, params)
+        if resp is None:
+            self.api.logger.debug('Attempting to %s %s', path, *args)
+            resp = self.api.session.request_safely(
+                method, self.api.session.url(path, *args), endpoint=path,
+                data=data, headers=headers,
+                params=params, max_attempts=max_attempts
+            )
+            self._cache(path, args, params, resp)
 
         return self._handle_response(resp, return_key=return_key, extra=extra)
 
     @requires_login
-    def feed(self, feed_type, *args, seen=None, raw=False):
+    def feed(self, feed_type, *args, seen=None, raw=False, exclude=None,
+             taken_after=None, where=None, since=None, since_id=None,
+             max_age=None, stream=False):
         """
 
         :param feed_type:
         :param args:
-        :param seen:
+        :param seen: seen-store of item ids, items in it are skipped and
+            the ids of yielded items are added to it
         :param raw:
+        :param exclude: ids of items to skip
+        :param taken_after: int: skip posts taken before this unix time
+        :param where: callable: only keep items whose raw dict passes it
+        :param since: int: watermark unix time, posts taken before it are
+            skipped and no more pages are requested after a page of them
+        :param since_id: int: watermark id, like `since` for the id of the
+            last seen item (ids increase over time)
+        :param max_age: float: skip posts taken more than this many seconds
+            ago, and stop requesting pages after a page of them
+        :param stream: bool: decode the items of each page one at a time
+            while the response is read, instead of decoding whole pages
         :return:
         """
         url = self.api.session.url(feed_type, *args)
         params, item_keys, has_more_key = self._params_for_feed(feed_type)
-        pages = _Pages(self.api, url, feed_type, params,
-                       item_keys, has_more_key, raw=raw)
+        pages = self._pages(self.api, url, feed_type, params,
+                            item_keys, has_more_key, raw=raw, seen=seen,
+                            stream=stream)
+        if exclude is not None:
+            pages.filter(lambda item: _item_id(item) not in exclude)
+        if taken_after is not None:
+            pages.filter(
+                lambda item: item.get('taken_at', taken_after) >= taken_after)
+        if where is not None:
+            pages.filter(where)
+        if since is not None:
+            pages.watermark(
+                lambda item: item.get('taken_at', since) < since)
+        if since_id is not None:
+            pages.watermark(
+                lambda item: (_item_id(item) or since_id + 1) <= since_id)
+        if max_age is not None:
+            pages.max_age(max_age)
         return pages
 
     @requires_login
@@ -96,7 +126,7 @@ class ApiMethod:
         headers = self.api.session.form_headers(boundary)
 
         resp = self.api.session.request_safely(
-            'POST', self.api.session.url(path),
+            'POST', self.api.session.url(path), endpoint=path,
             params=params, data=body, headers=headers)
 
         return self._handle_response(resp, return_key)
@@ -113,13 +143,41 @@ class ApiMethod:
     # +                'data' : json.dumps(self.find_urls(text)),
     # +            })
 
+    @staticmethod
+    def _pages(*args, **kwargs):
+        return _Pages(*args, **kwargs)
+
+    def _cache(self, path, args, params, response):
+        """Cache the response of a read, or invalidate the reads it changes"""
+        cache = self.api.response_cache
+        if cache is not None:
+            account = self.api.session.username
+            cache.invalidate(account, path, args)
+            if response.get('status') == 'ok' and \
+                    cache.cacheable(path, params):
+                cache.set(account, path, args, response)
+
+    def _cached(self, path, args, params):
+        """Cached response of a read, None if it is not cached"""
+        cache = self.api.response_cache
+        if cache is not None and cache.cacheable(path, params):
+            return cache.get(self.api.session.username, path, args)
+
+    def _action_data(self, path, args, data):
+        data = data or {}
+        if 'friendship' in self.api.session.paths[path] and args:
+            data['user_id'] = args[0]
+        elif 'media' in self.api.session.paths[path] and args:
+            data['media_id'] = args[0]
+        return data
+
     def _handle_response(self, response, return_key='', extra=None):
 
         status = response.pop('status', 'error')
         if status == 'ok':
             data = response
-            model = getattr(ModelFactory, return_key.strip('s'),
-                            ModelFactory.default)
+            models = self.api.models
+            model = getattr(models, return_key.strip('s'), models.default)
 
             if return_key and return_key in response:
                 data = response[return_key]
@@ -172,17 +230,27 @@ class ApiMethod:
 
 class _Pages:
     def __init__(self, api, url, feed_type, params,
-                 item_keys, has_more_key, raw=False):
-        # todo fix seen posts filtering
+                 item_keys, has_more_key, raw=False, seen=None,
+                 stream=False):
         self.api = api
+        self._filters = []
         self._items = []
         self._item_keys = item_keys
+        self._max_age = None
         self._iter = None
         self._has_more_key = has_more_key
+        self._cutoff = None
         self._last_request = 0
-        self._model = _feed_dict[feed_type]
+        self._feed_type = feed_type
+        self._model = getattr(api.models, _feed_dict[feed_type])
+        self._old = []
+        self._only_seen = False
+        self._page_stats = 0, 0
         self._params = params or {}
+        self._parsed = None
         self._raw = raw
+        self._seen = seen
+        self._stream = stream
         self._url = url
         self._response = {
             has_more_key: True,
@@ -201,10 +269,62 @@ class _Pages:
 
     @property
     def items(self):
-        if self._raw:
-            return self._items
-        else:
-            return self._model.parse_list(self.api, self._items)
+        """Items of the current page that pass the filters, parsed once"""
+        if self._parsed is None:
+            self._read_stream()
+            items = [item for item in self._items if self._keep(item)]
+            if not self._raw:
+                items = self._model.parse_list(self.api, items)
+            self._parsed = items
+        return self._parsed
+
+    @property
+    def has_more(self):
+        """Whether there are more pages, newer than the watermarks"""
+        return bool(self._response.get(self._has_more_key, False)) and \
+            not self._all_old()
+
+    def time_until_next_page(self):
+        """
+        Seconds until the next page can be requested without waiting for
+        page pacing or the rate limit of the feed's endpoint
+        """
+        pacing = max(0., sleep_between_pages - (time() - self._last_request))
+        limiter = self.api.session.limiter_for(self._feed_type)
+        return max(pacing, limiter.time_until_available())
+
+    def filter(self, predicate):
+        """
+        Only keep items whose raw dict passes `predicate`. Items are filtered
+        before they are parsed into models
+        :param predicate: callable: raw item -> bool
+        :return: self
+        """
+        self._filters.append(predicate)
+        self._parsed = None
+        return self
+
+    def watermark(self, is_old):
+        """
+        Skip items older than a watermark, and stop requesting pages once
+        every item on a page is older
+        :param is_old: callable: raw item -> bool
+        :return: self
+        """
+        self._old.append(is_old)
+        return self.filter(lambda item: not is_old(item))
+
+    def max_age(self, seconds):
+        """
+        Skip posts taken more than `seconds` ago, a watermark that moves with
+        the clock. The clock is read once per page
+        :param seconds: float
+        :return: self
+        """
+        self._max_age = seconds
+        self._cutoff = timestamp() - seconds
+        return self.watermark(
+            lambda item: item.get('taken_at', self._cutoff) < self._cutoff)
 
     def prev(self):
         self._items = self._get_data('prev')
@@ -216,31 +336,200 @@ class _Pages:
 
     def iter_pages(self):
         yield self
-        while self._response.get(self._has_more_key, False):
+        while self.has_more:
             yield self.next()
 
     def iter_items(self):
-        for item in self.items:
-            yield item
+        yield from self._iter_new()
 
         for page in self.iter_pages():
-            for item in page.items:
-                yield item
+            yield from page._iter_new()
+            if page._all_seen():
+                break
+
+    def iter_batches(self, columns=None):
+        """
+        Yield the new items of each page as a columns.Batch, without parsing
+        them into models
+        :param columns: names of the columns to extract, default all columns
+                        of the feed's model
+        """
+        for page in self.iter_pages():
+            batch = page._batch(columns)
+            if batch:
+                yield batch
+            if page._all_seen():
+                break
+
+    def batch(self, columns=None):
+        """
+        The rest of the feed as one columns.Batch, see iter_batches
+        :param columns: names of the columns to extract
+        :return: Batch
+        """
+        return Batch.concat(self.iter_batches(columns), self._model, columns)
 
     def _get_data(self, action):
-        sleep(max(0., sleep_between_pages - (time() - self._last_request)))
-        self._last_request = time()
+        sleep(self._page_delay())
+        if self._stream:
+            return self._stream_data(action)
+        self._response = self.api.session.request_safely(
+            'GET', self._url, endpoint=self._feed_type,
+            params=self._page_params(action), max_attempts=3)
+        return self._page_data()
+
+    def _batch(self, columns):
+        """New items of the current page as a Batch, marked as seen"""
+        self._read_stream()
+        if self._seen is None:
+            new = [item for item in self._items if self._keep(item)]
+        else:
+            ids, new = self._new_raw()
+            for item_id in ids:
+                if item_id is not None:
+                    self._seen.add(item_id)
+        return Batch.parse(self._model, new, columns)
+
+    def _iter_new(self):
+        """
+        Items of the current page that pass the filters and are not in the
+        seen-store. Duplicates are dropped from the raw page before any
+        models are parsed, and ids are marked as seen as items are yielded
+        """
+        if isinstance(self._items, stream.Page):
+            yield from self._iter_streamed()
+            return
+        if self._seen is None:
+            yield from self.items
+            return
+
+        ids, new = self._new_raw()
+        if not self._raw:
+            new = self._model.parse_list(self.api, new)
+        for item_id, item in zip(ids, new):
+            if item_id is not None:
+                self._seen.add(item_id)
+            yield item
+
+    def _new_raw(self):
+        """Ids and raw items of the page that are new and pass the filters"""
+        ids, new = [], []
+        on_page = set()
+        self._only_seen = bool(self._items)
+        for item in self._items:
+            item_id = _item_id(item)
+            if item_id is not None and (
+                    item_id in on_page or item_id in self._seen):
+                continue
+            self._only_seen = False
+            if self._keep(item):
+                on_page.add(item_id)
+                ids.append(item_id)
+                new.append(item)
+        return ids, new
+
+    def _iter_streamed(self):
+        """
+        Like _iter_new for a streamed page, whose items are filtered,
+        deduplicated and parsed one at a time as they are decoded
+        """
+        n_items = n_old = 0
+        on_page = set()
+        only_seen = True
+        for item in self._items:
+            n_items += 1
+            if any(is_old(item) for is_old in self._old):
+                n_old += 1
+            self._page_stats = n_items, n_old
+            item_id = _item_id(item)
+            if self._seen is not None and item_id is not None:
+                if item_id in on_page or item_id in self._seen:
+                    continue
+                on_page.add(item_id)
+            only_seen = False
+            if self._keep(item):
+                if not self._raw:
+                    item = self._model.parse(self.api, item)
+                if self._seen is not None and item_id is not None:
+                    self._seen.add(item_id)
+                yield item
+        self._only_seen = n_items > 0 and only_seen
+
+    def _all_old(self):
+        """Whether the page had items but all are older than a watermark"""
+        if isinstance(self._items, stream.Page):
+            n_items, n_old = self._page_stats
+            return bool(self._old) and 0 < n_items == n_old
+        if not self._old or not self._items:
+            return False
+        for item in self._items:
+            if not any(is_old(item) for is_old in self._old):
+                return False
+        return True
 
+    def _all_seen(self):
+        """
+        Whether the page had items but all of them were seen before, in which
+        case the rest of the feed has been read already
+        """
+        return self._seen is not None and self._only_seen
+
+    def _keep(self, item):
+        for predicate in self._filters:
+            if not predicate(item):
+                return False
+        return True
+
+    def _page_delay(self):
+        """Time to wait before requesting the next page"""
+        delay = max(0., sleep_between_pages - (time() - self._last_request))
+        self._last_request = time() + delay
+        return delay
+
+    def _new_page(self):
+        self._parsed = None  # items of the new page are parsed on access
+        self._only_seen = False
+        if self._max_age is not None:
+            self._cutoff = timestamp() - self._max_age
+
+    def _read_stream(self):
+        """Read all items of a streamed page, for access to the whole page"""
+        if isinstance(self._items, stream.Page):
+            self._items = list(self._items)
+
+    def _stream_data(self, action):
+        resp = self.api.session.request_safely(
+            'GET', self._url, endpoint=self._feed_type,
+            params=self._page_params(action), max_attempts=3,
+            return_json=False, check_json=True, stream=True)
+        page = stream.Page(resp.iter_content(stream_chunk_size),
+                           self._item_keys, close=resp.close)
+        # pagination keys are filled in as the page is read
+        self._response = page.response
+        self._page_stats = 0, 0
+        self._new_page()
+        return page
+
+    def _page_params(self, action):
         params = self._params.copy()
         params.update(max_id=self._response['%s_max_id' % action])
+        return params
 
-        self._response = self.api.session.request_safely(
-            'GET', self._url, params=params, max_attempts=3)
-
+    def _page_data(self):
+        self._new_page()
         data = []
         if self._response:
+            if len(self._item_keys) == 1:
+                # no copy of the only list of items
+                return self._response.get(self._item_keys[0], data)
             for k in self._item_keys:
                 data.extend(self._response.get(k, []))
         else:
             self._response = {self._has_more_key: False}
         return data
+
+
+def _item_id(item):
+    """Id of a raw feed item, None if it does not have one"""
+    item_id = item.get('pk')
+    return item.get('id') if item_id is None else item_id
@@ -0,0 +1,163 @@
+"""
+Cache of the responses of read endpoints, so that looking up the same user,
+post or friendship again does not spend a request of the rate limit budget.
+Responses are kept in memory and optionally in an SQLite database
+"""
+from collections import OrderedDict
+from threading import RLock
+from time import time
+import json
+import sqlite3
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    expires REAL NOT NULL,
+    body TEXT NOT NULL
+) WITHOUT ROWID;
+'''
+
+
+class ResponseCache:
+    """
+    Responses of api paths by account, path name and arguments, each kept
+    for the ttl of its path. Writes invalidate the responses they change,
+    e.g. following a user drops the cached friendship with and info of
+    that user. Requests with query params are not cached
+    :param ttls: dict: path name -> seconds, added to (or replacing) the
+                 default `ttls`, a ttl of 0 disables caching of a path
+    :param maxsize: number of responses kept in memory
+    :param path: path of an SQLite database responses are also kept in,
+                 default only in memory
+    """
+    # Seconds for which the response of a path is kept, by path name
+    ttls = {
+        'comments': 300,
+        'friendship': 300,
+        'geo_media': 3600,
+        'likers': 300,
+        'post': 600,
+        'story': 300,
+        'user': 900,
+        'username': 900,
+    }
+    # Paths whose response for the same first argument a write changes
+    invalidates = {
+        'follow': ('friendship', 'user'),
+        'unfollow': ('friendship', 'user'),
+        'block': ('friendship', 'user'),
+        'unblock': ('friendship', 'user'),
+        'approve': ('friendship', 'user'),
+        'ignore': ('friendship', 'user'),
+        'like': ('post', 'likers'),
+        'unlike': ('post', 'likers'),
+        'comment': ('post', 'comments'),
+        'remove_comment': ('post', 'comments'),
+        'save': ('post',),
+        'unsave': ('post',),
+        'edit_caption': ('post',),
+        'remove_tag': ('post',),
+        'remove_post': ('post', 'likers', 'comments'),
+    }
+
+    def __init__(self, ttls=None, maxsize=10000, path=None):
+        self.ttls = dict(self.ttls, **(ttls or {}))
+        self.maxsize = maxsize
+        self._lock = RLock()
+        self._memory = OrderedDict()  # key: (path, expires, body)
+        self._stats = {}
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.executescript(_schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @property
+    def stats(self):
+        """Hit/miss counters of every path looked up"""
+        with self._lock:
+            return {path: {'hits': hits, 'misses': misses}
+                    for path, (hits, misses) in self._stats.items()}
+
+    def key(self, account, path, args):
+        """Key of the response of a path for an account"""
+        return '%s:%s/%s' % (account, path, '/'.join(map(str, args)))
+
+    def cacheable(self, path, params=None):
+        return self.ttls.get(path, 0) > 0 and not params
+
+    def get(self, account, path, args):
+        """
+        Cached response of a path
+        :return: dict: json response, a new copy on every hit, or None
+        """
+        key = self.key(account, path, args)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None and self._db is not None:
+                entry = self._db.execute(
+                    'SELECT path, expires, body FROM responses WHERE key = ?',
+                    (key,)).fetchone()
+                if entry is not None:
+                    self._remember(key, entry)
+            if entry is not None and entry[1] <= time():
+                self._forget(key)
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+            self._count(path, entry is not None)
+        return entry and json.loads(entry[2])
+
+    def set(self, account, path, args, response):
+        """Cache a json response of a path for the ttl of the path"""
+        key = self.key(account, path, args)
+        entry = (path, time() + self.ttls[path], json.dumps(response))
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                        (key,) + entry)
+
+    def invalidate(self, account, path, args):
+        """Drop the cached responses a write to a path with args changes"""
+        if not args:
+            return
+        with self._lock:
+            for read_path in self.invalidates.get(path, ()):
+                self._forget(self.key(account, read_path, args[:1]))
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute('DELETE FROM responses')
+
+    def _count(self, path, hit):
+        hits, misses = self._stats.get(path, (0, 0))
+        self._stats[path] = (hits + hit, misses + (not hit))
+
+    def _forget(self, key):
+        self._memory.pop(key, None)
+        if self._db is not None:
+            with self._db:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
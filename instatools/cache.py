@@ -1,12 +1,21 @@
 """Response caching for testing integration with instatools"""
 
+import json
+import math
 import os
 import pickle
+import queue
 import re
 import sqlite3
+import struct
+import sys
+import zlib
 from contextlib import contextmanager
+from threading import Thread
+from urllib.request import pathname2url
 
 import requests
+from requests.structures import CaseInsensitiveDict
 
 import instatools.api
 import instatools.instagram.feeds
@@ -19,6 +28,26 @@ def clear(data_dir):
         os.remove(db_path)
 
 
+def migrate(data_dir):
+    """
+    Convert the responses of a cache recorded as pickled requests.Response
+    objects to the compact record format, see encode_response
+    :return: int: number of responses converted
+    """
+    db_path = os.path.join(data_dir, 'instagram_cache.db')
+    cache = DataBaseCache(db_path)
+    with cache.conn:
+        rows = [(encode_response(pickle.loads(value)), rowid)
+                for rowid, value in cache.cursor.execute(
+                    'select rowid, value from cache')
+                if not value.startswith(_record_magic)]
+        cache.cursor.executemany(
+            'update cache set value = ? where rowid = ?', rows)
+    cache.cursor.execute('vacuum')
+    cache.close()
+    return len(rows)
+
+
 @contextmanager
 def read(data_dir):
 
@@ -32,7 +61,11 @@ def read(data_dir):
         _handle_request(data_dir, old_request)
     instatools.api.sleep_between_pages = 0
     instatools.instagram.feeds.FeedReader._sleep_between_reads = 0
+    # recorded posts are as old as the recording
+    reset_after = instatools.instagram.feeds.FeedReader._reset_after
+    instatools.instagram.feeds.FeedReader._reset_after = math.inf
     yield
+    instatools.instagram.feeds.FeedReader._reset_after = reset_after
     instatools.session.Session._session_class.request = old_request
 
 
@@ -42,67 +75,259 @@ def record(data_dir):
     if not os.path.exists(data_dir):
         os.mkdir(data_dir)
 
-    cache = DataBaseCache(os.path.join(data_dir, 'instagram_cache.db'))
+    recorder = Recorder(os.path.join(data_dir, 'instagram_cache.db'))
     old_request = requests.Session.request
 
     def _request(self, method, url, **kwargs):
         resp = old_request(self, method, url, **kwargs)
-        cache.set(url, pickle.dumps(resp))
+        recorder.put(url, encode_response(resp),
+                     request_key(method, url, kwargs.get('params')))
         return resp
 
     instatools.session.Session._session_class.request = _request
     instatools.api.sleep_between_pages = 0
     instatools.instagram.feeds.FeedReader._sleep_between_reads = 0
-    yield
-    instatools.session.Session._session_class.request = old_request
+    try:
+        yield
+    finally:
+        instatools.session.Session._session_class.request = old_request
+        recorder.close()
+
+
+def request_key(method, url, params=None):
+    """Key of a recorded request: its method and url with query params"""
+    return '%s %s' % (method.upper(), requests.Request(
+        method, url, params=params).prepare().url)
+
+
+# Record format: magic, length of the json head, json head, zlib body
+_record_magic = b'ITR1'
+_record_head = struct.Struct('>I')
+_record_headers = ('Content-Type', 'Date')
+
+
+def encode_response(resp):
+    """
+    Compact record of a response, independent of the version of requests:
+    its status, url, encoding, a few headers and cookies, and the zlib
+    compressed body (decoded from any content encoding)
+    :param resp: requests.Response
+    :return: bytes
+    """
+    head = json.dumps({
+        'status': resp.status_code, 'reason': resp.reason, 'url': resp.url,
+        'encoding': resp.encoding,
+        'headers': {k: resp.headers[k]
+                    for k in _record_headers if k in resp.headers},
+        'cookies': [[c.name, c.value, c.domain, c.path]
+                    for c in resp.cookies]}).encode()
+    return b''.join([_record_magic, _record_head.pack(len(head)), head,
+                     zlib.compress(resp.content or b'')])
+
+
+def decode_response(record):
+    """
+    Response of a record made by encode_response, or of a pickled response
+    recorded by older versions
+    :param record: bytes
+    :return: requests.Response
+    """
+    if not record.startswith(_record_magic):
+        return pickle.loads(record)
+    start = len(_record_magic) + _record_head.size
+    end = start + _record_head.unpack_from(record, len(_record_magic))[0]
+    head = json.loads(record[start:end])
+    resp = requests.Response()
+    resp.status_code = head['status']
+    resp.reason = head['reason']
+    resp.url = head['url']
+    resp.encoding = head['encoding']
+    resp.headers = CaseInsensitiveDict(head['headers'])
+    for name, value, domain, path in head['cookies']:
+        resp.cookies.set(name, value, domain=domain, path=path)
+    resp._content = zlib.decompress(record[end:])
+    return resp
 
 
 class DataBaseCache(object):
+    """
+    Responses recorded per url in SQLite. Urls are looked up in the index of
+    the table, exactly or else by prefix, and values are only read when they
+    are replayed
+    :param read_only: open an existing recording for replay only, without
+                      creating or migrating its table and indexes
+    """
 
-    def __init__(self, db_path, default_factories=None):
-        self.conn = sqlite3.connect(db_path)
+    def __init__(self, db_path, default_factories=None, read_only=False):
+        if read_only:
+            self.conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(
+                os.path.abspath(db_path)), uri=True)
+        else:
+            self.conn = sqlite3.connect(db_path)
         self.cursor = self.conn.cursor()
-        self.cursor.execute('create table if not exists cache(key, value)')
-        self.conn.commit()
-        self._cache = {}
-        self._default_factories = default_factories or {}
-        for k, v in self.cursor.execute('select * from cache').fetchall():
-            self._cache[k] = v
+        if not read_only:
+            self._create_table()
+        self._default_factories = [
+            (re.compile(k), factory)
+            for k, factory in (default_factories or {}).items()]
+        self._keys = {}  # url: recorded key it matches, or None
+        self._turns = {}  # recorded key: (number of values, next to replay)
 
     def __del__(self):
-        self.conn.commit()
-        self.conn.close()
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
 
     def get(self, key):
-        result = self._cache.get(key, None)
-        if result is not None:
-            return result
+        recorded = self._match(key)
+        if recorded is not None:
+            # Replay the responses recorded for a key in order, so that
+            # pages of a feed differ like they did when they were recorded
+            n_values, turn = self._turns[recorded]
+            self._turns[recorded] = n_values, (turn + 1) % n_values
+            return self.cursor.execute(
+                'select value from cache where key=? order by rowid '
+                'limit 1 offset ?', (recorded, turn)).fetchone()[0]
         else:
-            for k, v in self._cache.items():
-                if k.startswith(key):
-                    return v
-
-            for k, factory in self._default_factories.items():
-                if re.search(k, key) is not None:
+            for pattern, factory in self._default_factories:
+                if pattern.search(key) is not None:
                     if callable(factory):
                         return factory()
                     return factory
 
-    def set(self, key, value):
-        self.cursor.execute('insert into cache values (?, ?)', (key, value))
-        self.conn.commit()
-        self._cache[key] = value
+    def set(self, key, value, request=None):
+        """
+        Record a value of a url
+        :param request: key of the request the value is the response to
+                        (see request_key), which replaces the value previously
+                        recorded for the same request
+        """
+        self.set_many([(key, value, request)])
+
+    def set_many(self, rows):
+        """Record (key, value, request) rows in one transaction"""
+        with self.conn:
+            self.cursor.executemany(
+                'insert into cache (key, value, request) values (?, ?, ?) '
+                'on conflict (request) do update set value = excluded.value',
+                rows)
+        self._forget()
 
     def delete(self, key):
         self.cursor.execute('delete from cache where key=?', (key,))
         self.conn.commit()
-        del self._cache[key]
+        self._forget()
 
     def clear(self):
         self.cursor.execute('drop table cache')
-        self.cursor.execute('create table cache(key, value)')
+        self._create_table()
+        self._forget()
+
+    def _create_table(self):
+        self.cursor.execute(
+            'create table if not exists cache(key, value, request unique)')
+        columns = [row[1] for row in self.cursor.execute(
+            'pragma table_info(cache)')]
+        if 'request' not in columns:
+            # recorded before requests were keyed
+            self.cursor.execute('alter table cache add column request')
+            self.cursor.execute('create unique index if not exists '
+                                'cache_request on cache(request)')
+        self.cursor.execute(
+            'create index if not exists cache_key on cache(key)')
         self.conn.commit()
 
+    def _forget(self):
+        self._keys.clear()
+        self._turns.clear()
+
+    def _match(self, key):
+        """Recorded key equal to `key`, or else the first starting with it"""
+        if key not in self._keys:
+            row = self.cursor.execute(
+                'select key from cache where key=? limit 1', (key,)).fetchone()
+            if row is None and key:
+                # the prefixes of a key sort right after it, until its last
+                # character is incremented
+                end = key[:-1] + chr(ord(key[-1]) + 1)
+                row = self.cursor.execute(
+                    'select key from cache where key>? and key<? '
+                    'order by key limit 1', (key, end)).fetchone()
+            self._keys[key] = row and row[0]
+            if row and row[0] not in self._turns:
+                self._turns[row[0]] = self.cursor.execute(
+                    'select count(*) from cache where key=?',
+                    row).fetchone()[0], 0
+        return self._keys[key]
+
+
+class Recorder(object):
+    """
+    Write-behind recording of responses: values are queued and written by a
+    background thread, many per transaction, so that recording does not wait
+    for the disk between requests. The database is put in WAL journal mode
+    :param db_path: path of the database of a DataBaseCache
+    :param max_queued: number of values queued before put blocks
+    :param batch_size: maximum number of values written per transaction
+    """
+
+    def __init__(self, db_path, max_queued=1000, batch_size=100):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._error = None
+        self._queue = queue.Queue(max_queued)
+        self._thread = Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def put(self, key, value, request=None):
+        """Queue a value to record, see DataBaseCache.set"""
+        self._queue.put((key, value, request))
+
+    def flush(self):
+        """Wait until every queued value is written"""
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        """Write the queued values and stop the background thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self):
+        cache = DataBaseCache(self.db_path)
+        cache.cursor.execute('pragma journal_mode=wal')
+        cache.cursor.execute('pragma synchronous=normal')
+        try:
+            closed = False
+            while not closed:
+                rows = [self._queue.get()]
+                while len(rows) < self.batch_size:
+                    try:
+                        rows.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                closed = rows[-1] is None
+                try:
+                    cache.set_many([row for row in rows if row is not None])
+                except Exception as e:
+                    # keep draining the queue so that put does not block
+                    self._error = e
+                for _ in rows:
+                    self._queue.task_done()
+        finally:
+            cache.close()
+
 
 def _handle_request(data_dir, request_method):
     success_response = requests.Response()
@@ -111,17 +336,22 @@ def _handle_request(data_dir, request_method):
     cache = DataBaseCache(
         os.path.join(data_dir, 'instagram_cache.db'),
         default_factories={
-            '.*': pickle.dumps(success_response)
-        })
+            '.*': encode_response(success_response)
+        }, read_only=True)
 
     def _request(self, method, url, **kwargs):
         if 'i.instagram.com/api' in url:
             result = cache.get(url)
             if result is not None:
-                response = pickle.loads(result)
+                response = decode_response(result)
                 response.cookies.update({'csrftoken': 'token'})
                 return response
 
         return request_method(self, method, url, **kwargs)
 
     return _request
+
+
+if __name__ == '__main__':
+    # python -m instatools.cache <data_dir>: convert an old recording
+    print('%d responses converted' % migrate(sys.argv[1]))
@@ -0,0 +1,105 @@
+"""
+Columnar batches of feed items, for jobs that reduce over a few fields of
+many items without needing a model per item
+"""
+from array import array
+from collections import OrderedDict
+from sys import intern
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+#: Value of a missing field in a numeric column
+missing = -1
+
+
+class Batch:
+    """
+    Items of a feed as a struct of arrays: one column per field, numbers
+    in typed arrays and strings interned. Columns are accessed by name
+    """
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def __repr__(self):
+        return 'Batch(%d items, columns=%s)' % (len(self), list(self.columns))
+
+    @classmethod
+    def parse(cls, model, items, columns=None):
+        """
+        Batch of raw items
+        :param model: model of the items, whose `columns` table gives the raw
+                      key and type of each column
+        :param items: list of raw items
+        :param columns: names of the columns to keep, default all
+        :return: Batch
+        """
+        batch = OrderedDict()
+        for name in columns or model.columns:
+            key, typecode = model.columns[name]
+            path = key.split('.')
+            values = [_get(item, path) for item in items]
+            if typecode is None:
+                batch[name] = [intern(v) if type(v) is str else v
+                               for v in values]
+            else:
+                batch[name] = array(typecode, [
+                    missing if v is None else v for v in values])
+        return cls(batch)
+
+    @classmethod
+    def concat(cls, batches, model, columns=None):
+        """
+        Concatenate batches of the same columns
+        :param batches: iterable of Batch
+        :param model: model of the items, for the columns of an empty result
+        :param columns: names of the columns of the batches, default all
+        :return: Batch
+        """
+        result = cls.parse(model, [], columns)
+        for batch in batches:
+            result.extend(batch)
+        return result
+
+    def extend(self, other):
+        """Append the items of a batch with the same columns to this batch"""
+        for name, column in self.columns.items():
+            column.extend(other.columns[name])
+        return self
+
+    def to_numpy(self):
+        """
+        Columns as numpy arrays (requires numpy), numeric ones without a copy
+        :return: dict: name -> numpy.ndarray
+        """
+        if numpy is None:
+            raise ImportError('Batch.to_numpy requires numpy: '
+                              'pip install instatools[numpy]')
+        return OrderedDict(
+            (name, numpy.frombuffer(column, dtype=column.typecode)
+             if isinstance(column, array) else numpy.array(column))
+            for name, column in self.columns.items())
+
+
+def _get(item, path):
+    for key in path:
+        if not isinstance(item, dict):
+            return None
+        item = item.get(key)
+    return item
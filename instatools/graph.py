@@ -0,0 +1,157 @@
+"""
+On-disk store of follower graphs: the ids of the followers and following of
+accounts, one set per (account, list type, snapshot), in an SQLite database.
+Sets are joined in the database, so memory use does not grow with them
+"""
+from itertools import islice
+from threading import RLock
+from time import time
+import sqlite3
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    account INTEGER NOT NULL,
+    list_type TEXT NOT NULL,
+    taken_at REAL NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS snapshots_by_list
+    ON snapshots (account, list_type, complete, id);
+CREATE TABLE IF NOT EXISTS ids (
+    snapshot INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (snapshot, user_id)
+) WITHOUT ROWID;
+'''
+
+
+class GraphStore:
+    """
+    Sets of user ids of accounts' follower lists
+    :param path: path of the database, default in memory
+    :param keep: number of complete snapshots kept per account and list type
+    :param chunk_size: number of ids inserted at once while recording
+    """
+    def __init__(self, path=':memory:', keep=2, chunk_size=1000):
+        self.keep = keep
+        self.chunk_size = chunk_size
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_schema)
+        self._lock = RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def record(self, account, list_type, user_ids):
+        """
+        Store a new snapshot of a list, appending ids as they are iterated,
+        e.g. while the pages of a feed are requested. The snapshot is only
+        used once the iterable is exhausted
+        :param account: id of the account
+        :param list_type: str: 'followers' or 'following'
+        :param user_ids: iterable of int
+        :return: int: id of the snapshot
+        """
+        with self._lock, self._db:
+            snapshot = self._db.execute(
+                'INSERT INTO snapshots (account, list_type, taken_at) '
+                'VALUES (?, ?, ?)', (account, list_type, time())).lastrowid
+        user_ids = iter(user_ids)
+        while True:
+            chunk = [(snapshot, user_id)
+                     for user_id in islice(user_ids, self.chunk_size)]
+            if not chunk:
+                break
+            with self._lock, self._db:
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO ids VALUES (?, ?)', chunk)
+        with self._lock, self._db:
+            self._db.execute('UPDATE snapshots SET complete = 1 WHERE id = ?',
+                             (snapshot,))
+            self._prune(account, list_type)
+        return snapshot
+
+    def latest(self, account, list_type, before=0):
+        """
+        Id of the latest complete snapshot of a list
+        :param before: number of snapshots to go back, e.g. 1 for the
+                       snapshot before the latest
+        :return: int or None if there is none
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT id FROM snapshots WHERE account = ? AND list_type = ? '
+                'AND complete = 1 ORDER BY id DESC LIMIT 1 OFFSET ?',
+                (account, list_type, before)).fetchone()
+        return row and row[0]
+
+    def count(self, snapshot):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM ids WHERE snapshot = ?',
+                (snapshot,)).fetchone()[0]
+
+    def ids(self, snapshot):
+        """Ids of a snapshot"""
+        return self._query('SELECT user_id FROM ids WHERE snapshot = ?',
+                           (snapshot,))
+
+    def contains(self, snapshot, user_ids):
+        """Which of `user_ids` are in a snapshot"""
+        user_ids = list(user_ids)
+        found = set()
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            found.update(self._query(
+                'SELECT user_id FROM ids WHERE snapshot = ? AND user_id IN '
+                '(%s)' % ', '.join('?' * len(chunk)), [snapshot] + chunk))
+        return found
+
+    def intersection(self, *snapshots):
+        """Ids in every one of the snapshots"""
+        return self._query(' INTERSECT '.join(
+            ['SELECT user_id FROM ids WHERE snapshot = ?'] * len(snapshots)),
+            snapshots)
+
+    def difference(self, snapshot, other):
+        """Ids in `snapshot` but not in `other`"""
+        return self._query(
+            'SELECT user_id FROM ids WHERE snapshot = ? EXCEPT '
+            'SELECT user_id FROM ids WHERE snapshot = ?', (snapshot, other))
+
+    def mutual(self, account):
+        """Ids of users that both follow and are followed by an account"""
+        followers = self.latest(account, 'followers')
+        following = self.latest(account, 'following')
+        if followers is None or following is None:
+            return iter(())
+        return self.intersection(followers, following)
+
+    def _prune(self, account, list_type):
+        old = [row[0] for row in self._db.execute(
+            'SELECT id FROM snapshots WHERE account = ? AND list_type = ? '
+            'AND complete = 1 ORDER BY id DESC LIMIT -1 OFFSET ?',
+            (account, list_type, self.keep))]
+        self._db.executemany('DELETE FROM ids WHERE snapshot = ?',
+                             [(i,) for i in old])
+        self._db.executemany('DELETE FROM snapshots WHERE id = ?',
+                             [(i,) for i in old])
+
+    def _query(self, sql, params):
+        """Yield the first column of the rows of a query, in chunks"""
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(self.chunk_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row[0]
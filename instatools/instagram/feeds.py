@@ -1,9 +1,16 @@
 
-from datetime import datetime
-from time import sleep
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import monotonic, sleep
+import math
+import random
 
-from ..api import ApiMethod
-from ..models import ModelFactory
+from .. import api as _api, seen as _seen
+
+# Feeds whose items are ordered by the time they were taken, the only ones
+# that can be read since a watermark time (liked, saved or timeline posts
+# are ordered by when they were liked, saved or ranked)
+_chronological_feeds = ('tag_feed', 'location_feed', 'user_feed')
 
 
 class Feeds:
@@ -12,47 +19,77 @@ class Feeds:
 
     @property
     def liked(self):
-        return FeedReader(self.api, 'liked')
+        return self.api.feed_reader('liked')
 
     @property
     def saved(self):
-        return FeedReader(self.api, 'saved')
+        return self.api.feed_reader('saved')
 
     @property
     def popular(self):
-        return FeedReader(self.api, 'popular')
+        return self.api.feed_reader('popular')
 
     @property
     def timeline(self):
-        return FeedReader(self.api, 'timeline')
+        return self.api.feed_reader('timeline')
 
     def location(self, search):
-        return FeedReader(self.api, 'location_feed', search)
+        return self.api.feed_reader('location_feed', search)
 
     def tag(self, search):
-        return FeedReader(self.api, 'tag_feed', search)
+        return self.api.feed_reader('tag_feed', search)
 
     def user(self, search):
-        return FeedReader(self.api, 'user_feed', search)
+        return self.api.feed_reader('user_feed', search)
 
     def user_tags(self, search):
-        return FeedReader(self.api, 'user_tags', search)
+        return self.api.feed_reader('user_tags', search)
 
 
 class FeedReader:
-
+    """
+    Reads a feed forever. After every pass over the feed it waits before
+    reading the feed again, for longer the fewer new items the feed has
+    been producing (between `_min_sleep_between_reads` and
+    `_sleep_between_reads` seconds)
+    """
+    _min_sleep_between_reads = 60
     _sleep_between_reads = 900
+    _jitter = 0.1
+    _reset_after = 86400
 
-    def __init__(self, api, feed_type, *args, reset_after=86400):
+    def __init__(self, api, feed_type, *args, reset_after=None, seen=None,
+                 since=None):
+        """
+        :param api: Instagram
+        :param feed_type: str: name of feed path
+        :param args: arguments of the feed path
+        :param reset_after: float: seconds after which posts are too old to
+            be read (default `_reset_after`), they are skipped before they
+            are parsed. Only used by chronological feeds
+        :param seen: seen-store of item ids (default from api.seen_store
+            and api.max_seen_items)
+        :param since: int: unix time of the newest post already read, each
+            reset only reads posts taken after the newest one read so far.
+            Only used by chronological feeds (tag, location and user feeds),
+            the others rely on `seen` alone
+        """
         self.api = api
         self.args = args
         self.feed_type = feed_type
-        self.reset_after = reset_after
+        self.reset_after = self._reset_after if reset_after is None \
+            else reset_after
+        self.since = since
 
-        self.seen = set()
+        self.seen = seen if seen is not None else _seen.create(
+            _api.seen_store, _api.max_seen_items)
         self.has_new_items = False
-        self.feed = ApiMethod(self.api).feed(
-            self.feed_type, *self.args, seen=self.seen)
+        self.rate = None
+        self._last_pass = None
+        self._newest = since
+        self._next_read = 0
+        self._read_in_pass = 0
+        self.feed = self._feed()
 
     def __iter__(self):
         return self
@@ -63,37 +100,185 @@ class FeedReader:
                 data = next(self.feed)
 
             except StopIteration:
-                if not self.has_new_items:
-                    sleep(self._sleep_between_reads)
-
-                self.has_new_items = False
+                self._end_pass()
+                sleep(self.time_until_ready())
                 self.reset()
 
             else:
+                self._track(data)
+                return data
 
-                if not self._is_recent(data):
-                    continue
+    def poll(self):
+        """
+        Read one pass of the feed without waiting for the next pass
+        :return: list: new items
+        """
+        items = []
+        for data in self.feed:
+            self._track(data)
+            items.append(data)
+        self._end_pass()
+        self.reset()
+        return items
 
-                self.has_new_items = True
-                return data
+    def expected_items(self):
+        """Number of new items the feed is expected to have by now"""
+        if self.rate is None:
+            return math.inf
+        return self.rate * (monotonic() - self._last_pass)
+
+    def time_until_ready(self):
+        """
+        Seconds until reading the feed will not block, either because an
+        exhausted feed is waiting to be re-read or because of rate limiting
+        """
+        return max(self._next_read - monotonic(),
+                   self.feed.time_until_next_page())
 
     def reset(self):
-        self.feed = ApiMethod(self.api).feed(
-            self.feed_type, *self.args, seen=self.seen)
+        self.since = self._newest
+        self.feed = self._feed()
+
+    def _end_pass(self, smoothing=0.5):
+        """Update the rate of new items and schedule the next pass"""
+        now = monotonic()
+        if self._last_pass is not None:
+            rate = self._read_in_pass / max(now - self._last_pass, 1e-9)
+            self.rate = rate if self.rate is None else (
+                smoothing * rate + (1 - smoothing) * self.rate)
+        self._last_pass = now
+        self.has_new_items = self._read_in_pass > 0
+        self._read_in_pass = 0
+        self._next_read = now + _poll_interval(
+            self.rate, self._min_sleep_between_reads,
+            self._sleep_between_reads, self._jitter)
 
-    def _is_recent(self, item):
-        return _age_of(item) <= self.reset_after
+    def _track(self, item):
+        """Remember the newest post read, the watermark of the next reset"""
+        self._read_in_pass += 1
+        taken_at = getattr(item, 'taken_at', None)
+        if taken_at is not None and self._chronological:
+            self._newest = max(self._newest or 0, taken_at)
+
+    @property
+    def _chronological(self):
+        return self.feed_type in _chronological_feeds
 
+    def _feed(self):
+        if not self._chronological:
+            return self.api.api_method().feed(
+                self.feed_type, *self.args, seen=self.seen)
+        return self.api.api_method().feed(
+            self.feed_type, *self.args, seen=self.seen, since=self.since,
+            max_age=self.reset_after)
 
-def _age_of(item):
+
+class FeedScheduler:
     """
-    Determine age (if possible) of an item (used for resetting feeds)
-    :param item:
-    :return:
+    Polls many FeedReaders from a single thread. Every feed is polled again
+    after an interval derived from the rate it has been producing new items
+    at, between `min_interval` and `max_interval` seconds and with random
+    jitter, so busy feeds are polled often and quiet feeds rarely.
+
+    Of the feeds that are due, the one expected to have the most new items
+    is polled first, and only while its rate limit has more than
+    `1 - budget` of its tokens left, the rest are kept for other requests:
+
+        scheduler = FeedScheduler([api.feeds.tag('beach'),
+                                   api.feeds.user(user_id)])
+        for reader, post in scheduler:
+            ...
     """
-    created = datetime.now()
+    def __init__(self, readers=(), min_interval=60, max_interval=3600,
+                 jitter=0.1, budget=0.5):
+        """
+        :param readers: FeedReaders to poll
+        :param min_interval: float: shortest time between polls of a feed
+        :param max_interval: float: longest time between polls of a feed
+        :param jitter: float: fraction by which intervals are randomised
+        :param budget: float: fraction of rate limits the polls can use
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.budget = budget
+        self._due = []  # heap of (poll at, insertion order, reader)
+        self._order = count()
+        for reader in readers:
+            self.add(reader)
 
-    if isinstance(item, ModelFactory.post):
-        created = datetime.fromtimestamp(item.taken_at)
+    def __iter__(self):
+        """Poll feeds forever, yielding (reader, item) for every new item"""
+        while True:
+            sleep(self.time_until_next_poll())
+            reader, items = self.poll()
+            for item in items:
+                yield reader, item
+
+    def __len__(self):
+        return len(self._due)
+
+    def add(self, reader):
+        """Add a feed, it is polled as soon as possible"""
+        heappush(self._due, (monotonic(), next(self._order), reader))
+        return reader
+
+    def remove(self, reader):
+        self._due = [entry for entry in self._due if entry[2] is not reader]
+        heapify(self._due)
+
+    def time_until_next_poll(self):
+        """Seconds until a feed is due and its rate limit budget allows it"""
+        if not self._due:
+            return self.min_interval
+        poll_at, _, reader = self._due[0]
+        return max(poll_at - monotonic(), self._time_until_budget(reader))
+
+    def poll(self):
+        """
+        Poll the due feed that is expected to have the most new items
+        :return: tuple: (FeedReader, list of new items), (None, []) if no
+            feed is due or the rate limit budget is spent
+        """
+        now = monotonic()
+        due = []
+        while self._due and self._due[0][0] <= now:
+            due.append(heappop(self._due))
+        if not due:
+            return None, []
 
-    return (datetime.now() - created).seconds
+        best = max(due, key=lambda entry: entry[2].expected_items())
+        for entry in due:
+            if entry is not best:
+                heappush(self._due, entry)
+
+        reader = best[2]
+        if self._time_until_budget(reader):
+            heappush(self._due, best)
+            return None, []
+
+        items = reader.poll()
+        interval = _poll_interval(reader.rate, self.min_interval,
+                                  self.max_interval, self.jitter)
+        heappush(self._due, (monotonic() + interval, best[1], reader))
+        return reader, items
+
+    def _time_until_budget(self, reader):
+        limiter = reader.api.session.limiter_for(reader.feed_type)
+        reserved = math.floor(limiter.burst * (1 - self.budget))
+        return limiter.time_until_available(min(reserved + 1, limiter.burst))
+
+
+def _poll_interval(rate, low, high, jitter, target=10):
+    """
+    Seconds until a feed producing `rate` new items per second has about
+    `target` new items, polling soon while the rate is unknown
+    """
+    if rate is None:
+        interval = low
+    elif rate == 0:
+        interval = high
+    else:
+        interval = target / rate
+    interval = min(max(interval, low), high)
+    return interval * random.uniform(1 - jitter, 1 + jitter)
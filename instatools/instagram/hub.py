@@ -1,7 +1,3 @@
-
-from ..api import ApiMethod
-
-
 class Hub:
     def __init__(self, api=None):
         self.api = api
@@ -31,4 +27,4 @@ class Hub:
         return self._get('recent_following_activity')
 
     def _get(self, path):
-        return ApiMethod(self.api).action(path, method='GET')
+        return self.api.api_method().action(path, method='GET')
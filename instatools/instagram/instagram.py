@@ -3,10 +3,14 @@ Public api for Instagram
 """
 from cached_property import threaded_cached_property_ttl as cached_property
 from collections import OrderedDict
+from threading import Event, RLock, Thread
+from time import time
+import os
+import pickle
 from ..api import ApiMethod
-from ..models import ModelFactory
+from ..models import IdentityMap, ModelFactory, dumps, loads
 from ..session import _make_logger, Session
-from .feeds import Feeds
+from .feeds import Feeds, FeedReader
 from .hub import Hub
 from .profile import Profile
 from .search import Search
@@ -16,9 +20,28 @@ from .search import Search
 
 
 class Instagram:
-
-    def __init__(self, username=None, password=None, session=None):
-        self.session = Session(username, password, session)
+    """
+    :param models: factory of the models returned by the api, e.g.
+                   ModelFactory.compact() to keep only the declared fields
+                   of posts, users and comments
+    :param identity_ttl: seconds for which a parsed user is shared by every
+                         later occurrence of it, default as long as it is
+                         referenced
+    :param graph: graph.GraphStore the ids of followers and following are
+                  stored in, by record_graph and on each Users.update
+    :param response_cache: apicache.ResponseCache the responses of reads
+                           like get_user and get_friendship are kept in
+    """
+
+    def __init__(self, username=None, password=None, session=None,
+                 models=ModelFactory, identity_ttl=None, graph=None,
+                 response_cache=None, **session_options):
+        self.graph = graph
+        self.identity_map = IdentityMap(identity_ttl)
+        self.models = models
+        self.response_cache = response_cache
+        self.session = Session(username, password, session,
+                               **session_options)
         self.logger = _make_logger(self.username)
         self.logged_in = session is not None
 
@@ -57,6 +80,14 @@ class Instagram:
         """Changes session password and metadata when set"""
         self.session.switch_user(self.username, password)
 
+    def api_method(self):
+        """ApiMethod making requests for this api"""
+        return ApiMethod(self)
+
+    def feed_reader(self, feed_type, *args, **kwargs):
+        """FeedReader of a feed of this api"""
+        return FeedReader(self, feed_type, *args, **kwargs)
+
     # =========================================== #
     #              ACCOUNT METHODS                #
     # =========================================== #
@@ -66,7 +97,7 @@ class Instagram:
         user = self.session.login()
         if user:
             self.logged_in = True
-            return ModelFactory.user.parse(self, user)
+            return self.models.user.parse(self, user)
         return False
 
     def logout(self):
@@ -91,139 +122,171 @@ class Instagram:
     # =========================================== #
 
     def follow(self, user_id):
-        return ApiMethod(self).action('follow', user_id,
-                                      return_key='friendship_status',
-                                      extra={'to': user_id})
+        return self.api_method().action('follow', user_id,
+                                        return_key='friendship_status',
+                                        extra={'to': user_id})
 
     def unfollow(self, user_id):
-        return ApiMethod(self).action('unfollow', user_id,
-                                      return_key='friendship_status',
-                                      extra={'to': user_id})
+        return self.api_method().action('unfollow', user_id,
+                                        return_key='friendship_status',
+                                        extra={'to': user_id})
 
     def approve(self, user_id):
-        return ApiMethod(self).action('approve', user_id,
-                                      return_key='friendship_status',
-                                      extra={'to': user_id})
+        return self.api_method().action('approve', user_id,
+                                        return_key='friendship_status',
+                                        extra={'to': user_id})
 
     def ignore(self, user_id):
-        return ApiMethod(self).action('ignore', user_id,
-                                      return_key='friendship_status',
-                                      extra={'to': user_id})
+        return self.api_method().action('ignore', user_id,
+                                        return_key='friendship_status',
+                                        extra={'to': user_id})
 
     def block(self, user_id):
-        return ApiMethod(self).action('block', user_id,
-                                      return_key='friendship_status',
-                                      extra={'to': user_id})
+        return self.api_method().action('block', user_id,
+                                        return_key='friendship_status',
+                                        extra={'to': user_id})
 
     def unblock(self, user_id):
-        return ApiMethod(self).action('unblock', user_id,
-                                      return_key='friendship_status',
-                                      extra={'to': user_id})
+        return self.api_method().action('unblock', user_id,
+                                        return_key='friendship_status',
+                                        extra={'to': user_id})
 
     def direct_message(self, recipients, msg):
         # todo add link detection
         # todo make utf-8 compliant for emojis
         bodies = self.session.form_data_for_message(recipients, msg)
-        return ApiMethod(self).form('direct_message',
-                                    bodies, self.session.uuid)
+        return self.api_method().form('direct_message',
+                                      bodies, self.session.uuid)
 
     def direct_share(self, post_id, recipients, msg=None):
         bodies = [dict(type='form-data', name='media_id', data=post_id)]
         bodies.extend(self.session.form_data_for_message(recipients, msg))
-        return ApiMethod(self).form('direct_share', bodies, self.session.uuid,
-                                    params={'media_type': 'photo'})
+        return self.api_method().form('direct_share', bodies,
+                                      self.session.uuid,
+                                      params={'media_type': 'photo'})
 
     # =========================================== #
     #               MEDIA METHODS                 #
     # =========================================== #
 
     def like(self, post_id):
-        return ApiMethod(self).action('like', post_id)
+        return self.api_method().action('like', post_id)
 
     def unlike(self, post_id):
-        return ApiMethod(self).action('unlike', post_id)
+        return self.api_method().action('unlike', post_id)
 
     def comment(self, post_id, text):
-        return ApiMethod(self).action('comment', post_id,
-                                      data={'comment_text': text},
-                                      return_key='comment')
+        return self.api_method().action('comment', post_id,
+                                        data={'comment_text': text},
+                                        return_key='comment')
 
     def remove_comment(self, post_id, comment_id):
-        return ApiMethod(self).action('remove_comment', post_id, comment_id)
+        return self.api_method().action('remove_comment', post_id, comment_id)
 
     def save(self, post_id):
-        return ApiMethod(self).action('save', post_id)
+        return self.api_method().action('save', post_id)
 
     def unsave(self, post_id):
-        return ApiMethod(self).action('unsave', post_id)
+        return self.api_method().action('unsave', post_id)
 
     def post(self, *args):
         pass
 
     def remove_post(self, post_id):
-        return ApiMethod(self).action('remove_post', post_id)
+        return self.api_method().action('remove_post', post_id)
 
     def remove_tag(self, post_id):
-        return ApiMethod(self).action('remove_tag', post_id)
+        return self.api_method().action('remove_tag', post_id)
 
     def edit_caption(self, post_id, new_caption):
-        return ApiMethod(self).action('edit_caption', post_id,
-                                      data={'caption_text': new_caption})
+        return self.api_method().action('edit_caption', post_id,
+                                        data={'caption_text': new_caption})
 
     # =========================================== #
     #               DATA METHODS                  #
     # =========================================== #
 
     def get_comments(self, post_id):
-        return ApiMethod(self).action('comments', post_id,
-                                      return_key='comments',
-                                      extra={'media_id': post_id})
+        return self.api_method().action('comments', post_id,
+                                        return_key='comments',
+                                        extra={'media_id': post_id})
 
     def get_followers(self, user_id=None):
         if user_id:
-            return list(ApiMethod(self).feed('followers', user_id))
+            return list(self.api_method().feed('followers', user_id))
 
         return self.followers.update()
 
     def get_following(self, user_id=None):
         if user_id:
-            return list(ApiMethod(self).feed('following', user_id))
+            return list(self.api_method().feed('following', user_id))
 
         return self.following.update()
 
+    def record_graph(self, list_type, user_id=None):
+        """
+        Stream the ids of a user's followers or following into self.graph,
+        without keeping the users in memory
+        :param list_type: str: 'followers' or 'following'
+        :param user_id: default the account's own id
+        :return: int: id of the snapshot in the graph store
+        """
+        user_id = user_id or self.username_id
+        feed = self.api_method().feed(list_type, user_id, raw=True)
+        return self.graph.record(user_id, list_type,
+                                 (item['pk'] for item in feed))
+
     def get_friendship(self, user_id):
-        return ApiMethod(self).action('friendship', user_id,
-                                      return_key='friendship_status',
-                                      extra={'to': user_id})
+        return self.api_method().action('friendship', user_id,
+                                        return_key='friendship_status',
+                                        extra={'to': user_id})
 
     def get_geo_media(self, user_id):
-        return ApiMethod(self).action('geo_media', user_id)
+        return self.api_method().action('geo_media', user_id)
 
     def get_likers(self, post_id):
-        return ApiMethod(self).action('likers', post_id, return_key='users')
+        return self.api_method().action('likers', post_id, return_key='users')
 
     def get_post(self, post_id):
-        return ApiMethod(self).action('post', post_id, return_key='items')[0]
+        return self.api_method().action('post', post_id, return_key='items')[0]
 
     def get_story(self, user_id):
-        return ApiMethod(self).action('story', user_id)
+        return self.api_method().action('story', user_id)
 
     def get_user(self, user_id):
-        return ApiMethod(self).action('user', user_id, return_key='user')
+        return self.api_method().action('user', user_id, return_key='user')
 
     def get_username(self, username):
-        return ApiMethod(self).action('username', username,
-                                      method='GET', return_key='user')
+        return self.api_method().action('username', username,
+                                        method='GET', return_key='user')
 
 
 class Users:
-    """Class representing new and removed users"""
-    def __init__(self, api=None, list_type=None):
+    """
+    Followers or following of the account, with the users that are new and
+    removed since the last update. With `full_sync_every` most updates are
+    incremental: the list is newest first, so reading stops at a run of
+    `known_run` users that are known already, which finds new users but not
+    removed ones. Removed users are found by a full sync of the list every
+    `full_sync_every` seconds, see update and reconcile
+    :param snapshot: path of a file the users (and the time of the last full
+                     sync) are saved to after each update, and loaded from
+                     before the first one
+    """
+    def __init__(self, api=None, list_type=None, snapshot=None,
+                 full_sync_every=0, known_run=20):
         self.all = OrderedDict()
         self.new = {}
         self.removed = {}
         self.type = list_type
         self.api = api
+        self.full_sync_every = full_sync_every
+        self.known_run = known_run
+        self.snapshot = snapshot
+        self._last_full_sync = None
+        self._loaded = False
+        self._lock = RLock()
+        self._stop = Event()
 
     def __contains__(self, item):
         return hasattr(item, 'id') and self.all.get(item.id, False)
@@ -239,21 +302,119 @@ class Users:
     @cached_property(60)
     def current(self):
         return {user.id: user for user in
-                ApiMethod(self.api).feed(self.type, self.api.username_id)}
-
-    def update(self):
+                self.api.api_method().feed(self.type, self.api.username_id)}
+
+    def update(self, full=None):
+        """
+        Sync the users with Instagram
+        :param full: bool: read the whole list, finding removed users as well
+                     as new ones. Default when `full_sync_every` seconds have
+                     passed since the last full sync
+        :return: list of all users
+        """
+        with self._lock:
+            self._load()
+            if full is None:
+                full = self._last_full_sync is None or \
+                    time() - self._last_full_sync >= self.full_sync_every
+            if full:
+                self._sync_all()
+            else:
+                self._sync_new()
+            self._save()
+            if self.api.graph is not None:
+                self.api.graph.record(self.api.username_id, self.type,
+                                      self.all)
+            return list(self.all.values())
+
+    def reconcile(self, every=None):
+        """
+        Run full syncs in a background thread until stop() is called
+        :param every: seconds between full syncs, default `full_sync_every`
+        :return: Thread
+        """
+        every = every or self.full_sync_every
+        if every <= 0:
+            raise ValueError('reconcile needs a positive interval: pass '
+                             'every or set full_sync_every')
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(self._time_until_full_sync(every)):
+                try:
+                    self.update(full=True)
+                except Exception:
+                    self.api.logger.exception('Could not sync %s', self.type)
+                    self._stop.wait(every)
+
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Stop the background syncs started by reconcile"""
+        self._stop.set()
+
+    def _sync_all(self):
+        # Users parsed again are the objects in self.all already (see
+        # IdentityMap), updated in place, so only ids that changed are moved
         users = self.current
-        previous_users = set(self.all.keys())
-        new_users = set(users.keys())
-        new = [users[i] for i in new_users.difference(previous_users)]
-        removed = [users[i] for i in previous_users.difference(new_users)]
-
         self.new.clear()
         self.removed.clear()
-        for user in new:
-            self.all[user.id] = self.new[user.id] = user
-        for user in removed:
-            self.removed[user.id] = user
-            del self.all[user.id]
+        for user_id in [i for i in self.all if i not in users]:
+            self.removed[user_id] = self.all.pop(user_id)
+        for user_id, user in users.items():
+            if user_id not in self.all:
+                self.all[user_id] = self.new[user_id] = user
+        self._last_full_sync = time()
+
+    def _sync_new(self):
+        new, known = [], 0
+        feed = self.api.api_method().feed(self.type, self.api.username_id,
+                                          raw=True)
+        for item in feed:
+            if item.get('pk') in self.all:
+                known += 1
+                if known >= self.known_run:
+                    break
+            else:
+                known = 0
+                new.append(item)
 
-        return list(self.all.values())
+        self.new.clear()
+        self.removed.clear()
+        for user in self.api.models.user.parse_list(self.api, new):
+            if user.id not in self.all:
+                self.new[user.id] = user
+        # newest users first, as in the list
+        for user_id, user in reversed(list(self.new.items())):
+            self.all[user_id] = user
+            self.all.move_to_end(user_id, last=False)
+
+    def _time_until_full_sync(self, every):
+        if self._last_full_sync is None:
+            return 0
+        return max(0., self._last_full_sync + every - time())
+
+    def _load(self):
+        if self._loaded or not self.snapshot:
+            return
+        self._loaded = True
+        try:
+            with open(self.snapshot, 'rb') as f:
+                self._last_full_sync, users = pickle.load(f)
+        except FileNotFoundError:
+            return
+        users = loads(users, self.api)
+        self.all = OrderedDict((user.id, user) for user in users)
+        for user in users:
+            self.api.identity_map.add(user)
+
+    def _save(self):
+        if not self.snapshot:
+            return
+        path = self.snapshot + '.tmp'
+        with open(path, 'wb') as f:
+            pickle.dump((self._last_full_sync,
+                         dumps(list(self.all.values()))), f)
+        os.replace(path, self.snapshot)
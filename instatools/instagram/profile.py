@@ -1,5 +1,4 @@
 from cached_property import threaded_cached_property
-from ..api import ApiMethod
 
 
 class Profile:
@@ -20,16 +19,16 @@ class Profile:
 
     @property
     def follow_requests(self):
-        return ApiMethod(self.api).feed('pending')
+        return self.api.api_method().feed('pending')
 
     def threads(self, thread, cursor=None):
         # todo fix for usability
         params = {'cursor': cursor} if cursor else {}
-        return ApiMethod(self.api).action('direct_threads', thread,
-                                          params=params)
+        return self.api.api_method().action('direct_threads', thread,
+                                            params=params)
 
     def change_password(self, new_password):
-        success = ApiMethod(self.api).action('change_password', data={
+        success = self.api.api_method().action('change_password', data={
             'old_password': self.api.password,
             'new_password1': new_password,
             'new_password2': new_password
@@ -68,12 +67,12 @@ class Profile:
 
     @threaded_cached_property
     def _user(self):
-        return ApiMethod(self.api).action('profile',
-                                          params={'edit': True},
-                                          return_key='user')
+        return self.api.api_method().action('profile',
+                                            params={'edit': True},
+                                            return_key='user')
 
     def _edit(self, *args, **kwargs):
-        success = ApiMethod(self.api).action(*args, **kwargs)
+        success = self.api.api_method().action(*args, **kwargs)
         if success and '_user' in self.__dict__:
             # Invalidate cached profile
             del self.__dict__['_user']
@@ -1,7 +1,3 @@
-
-from ..api import ApiMethod
-
-
 class Search:
     def __init__(self, api=None):
         self.api = api
@@ -48,6 +44,6 @@ class Search:
 
     def _search(self, path, params, return_key=None):
         params.update(rank_token=self.api.session.rank_token)
-        return ApiMethod(self.api).action(path,
-                                          params=params,
-                                          return_key=return_key)
+        return self.api.api_method().action(path,
+                                            params=params,
+                                            return_key=return_key)
@@ -1,5 +1,11 @@
-from cached_property import threaded_cached_property_ttl as cached_property
-from time import time as timestamp
+from abc import ABCMeta
+from cached_property import cached_property_with_ttl, \
+    threaded_cached_property_ttl as cached_property
+from threading import RLock
+from time import monotonic, time as timestamp
+import asyncio
+import pickle
+import weakref
 
 
 class _Downloader:
@@ -9,38 +15,188 @@ class _Downloader:
 downloader = _Downloader()
 
 
-class Model(object):
+def _shared(result):
+    """
+    Results of asyncio apis are wrapped in a task, so that a cached result
+    can be awaited more than once
+    """
+    if asyncio.iscoroutine(result):
+        return asyncio.ensure_future(result)
+    return result
+
+
+_missing = object()
+
+
+class Model(object, metaclass=ABCMeta):
+    """
+    Fields of a model are parsed from its raw json the first time they are
+    used, as attributes named after their key in the json, or renamed by the
+    model's `keys` table. Values of keys in the `converters` table are
+    converted with `converter(api, value)` when parsed. Model itself has no
+    instance __dict__, its subclasses do unless they are compact
+    """
+    __slots__ = ('_api', '_json', '__weakref__')
+    #: Attributes kept by the compact version of the model, see compact()
+    fields = ()
+    #: Columns of the model in a columns.Batch: name -> (raw key, array
+    #: typecode or None for strings); nested keys are joined with dots
+    columns = {}
+    keys = {}
+    converters = {}
+    #: Models of the class are shared by id through the api's identity_map
+    _identity = False
+    _sources = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # attribute: the raw keys it is parsed from, in order of preference
+        cls._sources = {}
+        for key, name in cls.keys.items():
+            cls._sources.setdefault(name, []).append(key)
+
     def __init__(self, api, json):
         self._api = api
         self._json = json
 
+    def __getattr__(self, name):
+        if not name.startswith('_') and self._json:
+            value = self._parse(name)
+            if value is not _missing:
+                self._set(name, value)
+                return value
+        raise AttributeError('%r object has no attribute %r' % (
+            type(self).__name__, name))
+
     def __hash__(self):
         return getattr(self, 'id', -1)
 
     def __getstate__(self):
-        # pickle
-        pickle = dict(self.__dict__)
-        try:
-            del pickle['_api']  # do not pickle the API reference
-        except KeyError:
-            pass
+        # Only the raw json is pickled (not the API reference), fields are
+        # parsed from it again once loaded. Nested models that were parsed
+        # already are pickled as models, so pickle stores shared ones once
+        json = self._json
+        pickle = {}
+        for name, value in self._values():
+            keys = self._keys_of(name)
+            if not json or not any(key in json for key in keys):
+                pickle[name] = value
+            elif isinstance(value, Model):
+                pickle[name] = value
+                json = {k: v for k, v in json.items() if k not in keys}
+        pickle['_json'] = json
         return pickle
 
+    def __setstate__(self, state):
+        self._api = None
+        for k, v in state.items():
+            setattr(self, k, v)
+
     def __repr__(self):
         return '{:s}(id={:s})'.format(self.__class__.__name__,
                                       str(getattr(self, 'id', -1)))
 
+    def _convert(self, key, value):
+        convert = self.converters.get(key)
+        return convert(self._api, value) if convert else value
+
+    def _keys_of(self, name):
+        """Raw keys a field is parsed from"""
+        sources = self._sources.get(name)
+        if sources is None:
+            return () if name in self.keys else (name,)
+        return sources
+
+    def _parse(self, name):
+        """Value of a field parsed from the raw json, or _missing"""
+        for key in self._keys_of(name):
+            if key in self._json:
+                return self._convert(key, self._json[key])
+        return _missing
+
+    def _set(self, name, value):
+        setattr(self, name, value)
+
+    def _update(self, json, extra=None):
+        """Update the model in place with a newer raw json of it"""
+        stale = [name for name, _ in self._values()
+                 if any(key in json for key in self._keys_of(name))]
+        for name in stale:
+            delattr(self, name)
+        merged = dict(self._json or ())
+        merged.update(json)
+        self._json = merged
+        for k, v in (extra or {}).items():
+            self._set(self.keys.get(k, k), self._convert(k, v))
+
+    def _values(self):
+        """Attributes set on the model, except its api and json"""
+        for name, value in self.__dict__.items():
+            if name not in ('_api', '_json'):
+                yield name, value
+
+    def _parsed(self, api):
+        """Called once a new model is parsed"""
+
+    @classmethod
+    def compact(cls, keep_raw=False):
+        """
+        Version of the model that only stores its declared `fields`, in
+        __slots__ without an instance __dict__. It has the methods of the
+        model and is registered as a virtual subclass of it
+        :param keep_raw: keep the raw json to read any other key from lazily,
+                         otherwise other keys are dropped
+        :return: class of compact models
+        """
+        key = cls, keep_raw
+        if key not in _compact_models:
+            # Subclassing the model would inherit its __dict__, so the
+            # compact class is built from the namespaces of its classes
+            namespace = {}
+            for klass in reversed(cls.__mro__[:cls.__mro__.index(Model)]):
+                namespace.update(klass.__dict__)
+            for name in ('__dict__', '__weakref__') + cls.fields:
+                namespace.pop(name, None)
+            cached = [name for name, value in namespace.items()
+                      if isinstance(value, cached_property_with_ttl)]
+            for name in cached:
+                namespace[name] = _SlotCachedProperty(namespace[name])
+            name = ('CompactRaw' if keep_raw else 'Compact') + cls.__name__
+            namespace.update({
+                '__qualname__': name,
+                '__slots__': cls.fields + (('_cache',) if cached else ()),
+                '_keep_raw': keep_raw, '_model': cls,
+                '_fields': frozenset(cls.fields),
+                # field -> ((raw key, converter or None), ...) to parse it
+                '_plan': tuple(
+                    (name, tuple((key, cls.converters.get(key))
+                                 for key in cls._keys_of(cls, name)))
+                    for name in cls.fields)})
+            compact = type(name, (_Compact, Model), namespace)
+            cls.register(compact)
+            _compact_models[key] = compact
+        return _compact_models[key]
+
     @classmethod
     def parse(cls, api, json, extra=None):
-        model = cls(api, json)
+        identity_map = getattr(api, 'identity_map', None) \
+            if cls._identity else None
+        if identity_map is not None:
+            # Every occurrence of a model is the same object, updated in place
+            model = identity_map.get(json.get('pk'))
+            if isinstance(model, cls):
+                model._update(json, extra)
+                return model
 
-        for k, v in json.items():
-            setattr(model, k, v)
+        model = cls(api, json)
 
         if extra:
             for k, v in extra.items():
-                setattr(model, k, v)
+                model._set(cls.keys.get(k, k), model._convert(k, v))
 
+        model._parsed(api)
+        if identity_map is not None:
+            identity_map.add(model)
         return model
 
     @classmethod
@@ -51,20 +207,133 @@ class Model(object):
         return items
 
 
-class Comment(Model):
+class _Compact:
+    """Mixin of the classes created by Model.compact"""
+    __slots__ = ()
+    _keep_raw = False
+
+    def _values(self):
+        for name in self.fields:
+            try:
+                yield name, object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+
+    def __reduce__(self):
+        # Compact classes are created at runtime, so pickle their model
+        return _new_compact, (self._model, self._keep_raw), self.__getstate__()
+
+    def _set(self, name, value):
+        if name in self._fields:
+            setattr(self, name, value)
+
+    def _drop_raw(self):
+        """Parse the declared fields, then forget the raw json"""
+        if self._keep_raw or self._json is None:
+            return
+        json, api = self._json, self._api
+        for name, sources in self._plan:
+            for key, convert in sources:
+                if key in json:
+                    value = json[key]
+                    setattr(self, name,
+                            convert(api, value) if convert else value)
+                    break
+        self._json = None
+
+    def _update(self, json, extra=None):
+        super()._update(json, extra)
+        self._drop_raw()
+
     @classmethod
     def parse(cls, api, json, extra=None):
-        model = cls(api, json)
+        model = super().parse(api, json, extra)
+        model._drop_raw()
+        return model
 
-        for k, v in json.items():
-            if k == 'pk':
-                setattr(model, 'id', v)
-            elif k == 'media_id':
-                setattr(model, 'post_id', v)
-            else:
-                setattr(model, k, v)
 
-        return model
+_compact_models = {}
+
+
+class _SlotCachedProperty:
+    """
+    Cached property with a ttl of compact models, cached in their `_cache`
+    slot instead of their (missing) __dict__
+    """
+    def __init__(self, prop):
+        self.func = prop.func
+        self.ttl = prop.ttl
+        self.__doc__ = prop.__doc__
+        self.__name__ = prop.__name__
+        self._lock = RLock()
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        with self._lock:
+            try:
+                cache = obj._cache
+            except AttributeError:
+                cache = obj._cache = {}
+            now = timestamp()
+            value, updated = cache.get(self.__name__, (None, None))
+            if updated is None or self.ttl and self.ttl < now - updated:
+                value = self.func(obj)
+                cache[self.__name__] = value, now
+            return value
+
+
+def _new_compact(model, keep_raw):
+    cls = model.compact(keep_raw)
+    return cls.__new__(cls)
+
+
+class IdentityMap:
+    """
+    Weak references to the models of an api by id, so that models parsed
+    again resolve to the one already in memory
+    :param ttl: seconds after which a model is no longer shared, and parsing
+                it again creates a new one
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._refs = {}
+
+    def __len__(self):
+        return len(self._refs)
+
+    def add(self, model):
+        model_id = getattr(model, 'id', None)
+        if model_id is None:
+            return
+
+        def forget(ref):
+            if self._refs.get(model_id, (None,))[0] is ref:
+                del self._refs[model_id]
+
+        self._refs[model_id] = weakref.ref(model, forget), monotonic()
+
+    def get(self, model_id):
+        """Shared model with the given id, None if there is none"""
+        ref, added = self._refs.get(model_id, (None, None))
+        if ref is None:
+            return None
+        if self.ttl is not None and monotonic() - added > self.ttl:
+            self._refs.pop(model_id, None)
+            return None
+        return ref()
+
+
+class Comment(Model):
+    fields = ('id', 'post_id', 'text', 'user_id', 'user', 'created_at')
+    keys = {'pk': 'id', 'media_id': 'post_id'}
+    columns = {
+        'id': ('pk', 'q'),
+        'post_id': ('media_id', 'q'),
+        'user_id': ('user_id', 'q'),
+        'text': ('text', None),
+        'created_at': ('created_at', 'q'),
+    }
 
     def reply(self, msg):
         pass
@@ -75,73 +344,137 @@ class Comment(Model):
 
 # todo location model
 class Location(Model):
-    @classmethod
-    def parse(cls, api, json, extra=None):
-        model = cls(api, json)
+    pass
 
-        for k, v in json.items():
-            if k == '':
-                setattr(model, '', v)
-            else:
-                setattr(model, k, v)
 
-        return model
+_media_types = {1: 'image', 2: 'video', 8: 'gif'}
 
 
-class Post(Model):
-    @classmethod
-    def parse(cls, api, json, extra=None):
-        model = cls(api, json)
+def _area(candidate):
+    return candidate.get('width', 0) * candidate.get('height', 0)
 
-        for k, v in json.items():
-
-            # Media data
-            if k == 'pk':
-                setattr(model, 'id', v)
-            elif k == 'id':
-                setattr(model, 'media_id', v)
-            elif k == 'like_count':
-                setattr(model, 'likes', v)
-            elif k == 'has_likes':
-                setattr(model, 'liked_by_me', v)
-            elif k == 'user':
-                setattr(model, 'user', ModelFactory.user.parse(api, v))
-
-            # Image / Thumbnails
-            elif k == 'image_versions2':
-                setattr(model, 'image_versions', sorted(
-                    v.get('candidates', []),
-                    key=lambda t: t['width'] * t['height']
-                ))
-            # GIFs
-            elif k == 'carousel_media' and len(v) > 0:
-                setattr(model, 'image_versions', sorted(
-                    v[0].get('image_versions2', {}).get('candidates', []),
-                    key=lambda t: t['width'] * t['height']
-                ))
-            elif k == 'media_type':
-                media_types = {1: 'image', 2: 'video', 8: 'gif'}
-                setattr(model, 'media_type', media_types[v])
-            # Video
-            elif k == 'original_width':
-                setattr(model, 'width', v)
-            elif k == 'original_height':
-                setattr(model, 'height', v)
-            elif k == 'video_duration':
-                setattr(model, 'duration', v)
-
-            else:
-                setattr(model, k, v)
 
-        return model
+class ImageVersions:
+    """
+    Image candidates (dicts with url, width and height) of a post. Sizes are
+    looked up in one pass over the candidates when first needed, iterating
+    or indexing goes from smallest to largest. A carousel post has the
+    candidates of its first item, and those of every item in `children`
+    """
+    def __init__(self, candidates, carousel=()):
+        self.candidates = candidates
+        self._carousel = carousel
+        self._children = None
+        self._closest = {}
+        self._largest = self._smallest = self._sorted = None
+
+    def __getitem__(self, index):
+        return self.by_size[index]
+
+    def __iter__(self):
+        return iter(self.by_size)
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def __repr__(self):
+        return 'ImageVersions(%d candidates, %d children)' % (
+            len(self), len(self._carousel))
+
+    @property
+    def by_size(self):
+        """Candidates sorted from smallest to largest"""
+        if self._sorted is None:
+            self._sorted = sorted(self.candidates, key=_area)
+        return self._sorted
+
+    @property
+    def children(self):
+        """ImageVersions of each item of a carousel post"""
+        if self._children is None:
+            self._children = [
+                ImageVersions(item.get('image_versions2', {}).get(
+                    'candidates', [])) for item in self._carousel]
+        return self._children
+
+    @property
+    def largest(self):
+        if self._largest is None and self.candidates:
+            self._largest = max(self.candidates, key=_area)
+        return self._largest
+
+    @property
+    def smallest(self):
+        if self._smallest is None and self.candidates:
+            self._smallest = min(self.candidates, key=_area)
+        return self._smallest
+
+    def closest(self, width, height=None):
+        """
+        Candidate closest to a size
+        :param width: int
+        :param height: int, default `width`
+        :return: dict or None if there are no candidates
+        """
+        size = width, width if height is None else height
+
+        def distance(t):
+            return abs(t.get('width', 0) - size[0]) + \
+                abs(t.get('height', 0) - size[1])
+
+        if size not in self._closest and self.candidates:
+            self._closest[size] = min(self.candidates, key=distance)
+        return self._closest.get(size)
+
+
+class Post(Model):
+    fields = ('id', 'media_id', 'code', 'user', 'caption', 'taken_at',
+              'likes', 'comment_count', 'liked_by_me', 'media_type',
+              'image_versions', 'width', 'height', 'duration')
+
+    keys = {
+        # Media data
+        'pk': 'id',
+        'id': 'media_id',
+        'like_count': 'likes',
+        'has_likes': 'liked_by_me',
+        # Image / Thumbnails, GIFs
+        'image_versions2': 'image_versions',
+        'carousel_media': 'image_versions',
+        # Video
+        'original_width': 'width',
+        'original_height': 'height',
+        'video_duration': 'duration',
+    }
+    columns = {
+        'id': ('pk', 'q'),
+        'media_id': ('id', None),
+        'code': ('code', None),
+        'user_id': ('user.pk', 'q'),
+        'username': ('user.username', None),
+        'taken_at': ('taken_at', 'q'),
+        'likes': ('like_count', 'q'),
+        'comment_count': ('comment_count', 'q'),
+        'view_count': ('view_count', 'q'),
+        'media_type': ('media_type', 'b'),
+    }
+    converters = {
+        'user': lambda api, v: _models(api).user.parse(api, v),
+        'image_versions2': lambda api, v: ImageVersions(
+            v.get('candidates', [])),
+        'carousel_media': lambda api, v: ImageVersions(
+            v[0].get('image_versions2', {}).get('candidates', [])
+            if v else [], carousel=v),
+        'media_type': lambda api, v: _media_types[v],
+    }
 
     @cached_property(60)
     def comments(self):
-        return self._api.get_comments(self.id)
+        return _shared(self._api.get_comments(self.id))
 
     @cached_property(60)
     def likers(self):
-        return self._api.get_likers(self.id)
+        return _shared(self._api.get_likers(self.id))
 
     def download(self):
         pass
@@ -161,49 +494,41 @@ class Post(Model):
 
 class Relationship(Model):
 
-    @classmethod
-    def parse(cls, api, json, extra=None):
-        model = cls(api, json)
-
-        for k, v in json.items():
-            setattr(model, k, v)
-
-        if extra and extra.get('to', False):
-            setattr(model, 'to', extra.get('to'))
-
-        return model
-
     def __repr__(self):
         return 'Relationship(to=%s, from=%s)' % (
             self._api.username_id, self.to)
 
 
 class User(Model):
-    @classmethod
-    def parse(cls, api, json, extra=None):
-        model = cls(api, json)
-
-        for k, v in json.items():
-            if k == 'pk':
-                setattr(model, 'id', v)
-            elif k == 'biography':
-                setattr(model, 'bio', v)
-            elif k == 'is_private':
-                setattr(model, 'private', v)
-            elif k == 'follower_count':
-                setattr(model, 'n_followers', v)
-            elif k == 'following_count':
-                setattr(model, 'n_following', v)
-            elif k == 'media_count':
-                setattr(model, 'n_posts', v)
-            else:
-                setattr(model, k, v)
-
+    fields = ('id', 'username', 'full_name', 'bio', 'private', 'is_verified',
+              'profile_pic_url', 'n_followers', 'n_following', 'n_posts',
+              'followed_me_at')
+
+    keys = {
+        'pk': 'id',
+        'biography': 'bio',
+        'is_private': 'private',
+        'follower_count': 'n_followers',
+        'following_count': 'n_following',
+        'media_count': 'n_posts',
+    }
+    columns = {
+        'id': ('pk', 'q'),
+        'username': ('username', None),
+        'full_name': ('full_name', None),
+        'private': ('is_private', 'b'),
+        'is_verified': ('is_verified', 'b'),
+        'n_followers': ('follower_count', 'q'),
+        'n_following': ('following_count', 'q'),
+        'n_posts': ('media_count', 'q'),
+    }
+
+    _identity = True
+
+    def _parsed(self, api):
         # This is so Users object can track other people's follow durations
-        if getattr(model, 'id', -1) != api.username_id:
-            model.followed_me_at = timestamp()
-
-        return model
+        if getattr(self, 'id', -1) != getattr(api, 'username_id', None):
+            self._set('followed_me_at', timestamp())
 
     @property
     def feed(self):
@@ -211,11 +536,11 @@ class User(Model):
 
     @cached_property(3600)
     def followers(self):
-        return self._api.get_followers(self.id)
+        return _shared(self._api.get_followers(self.id))
 
     @cached_property(3600)
     def following(self):
-        return self._api.get_following(self.id)
+        return _shared(self._api.get_following(self.id))
 
     def follow(self):
         return self._api.follow(self.id)
@@ -245,12 +570,67 @@ class User(Model):
         return 'User(%s)' % (self.username,)
 
 
+class Data(Model):
+    """Model of responses without a model of their own"""
+
+
 class ModelFactory:
 
-    default = Model
+    default = Data
 
     comment = Comment
     location = Location
     post = item = ranked_item = Post
     relationship = friendship_status = Relationship
     user = User
+
+    @classmethod
+    def compact(cls, keep_raw=False):
+        """
+        Factory of compact comments, posts and users, see Model.compact
+        :param keep_raw: keep the raw json of each model
+        """
+        post = Post.compact(keep_raw)
+        return type('CompactModelFactory', (cls,), {
+            'comment': Comment.compact(keep_raw),
+            'post': post, 'item': post, 'ranked_item': post,
+            'user': User.compact(keep_raw)})
+
+
+def _models(api):
+    """Model factory of an api, default for models loaded without one"""
+    return getattr(api, 'models', ModelFactory)
+
+
+def dumps(models, protocol=pickle.HIGHEST_PROTOCOL):
+    """
+    Pickle a list of models (e.g. a snapshot of followers or a feed), storing
+    each nested user once per id across the whole list
+    :param models: list of Model
+    :param protocol: pickle protocol
+    :return: bytes
+    """
+    users = {}
+    for model in models:
+        user = getattr(model, 'user', None) if isinstance(
+            model, (Comment, Post)) else None
+        if isinstance(user, User):
+            model._set('user', users.setdefault(user.id, user))
+    return pickle.dumps(list(models), protocol)
+
+
+def loads(data, api=None):
+    """
+    Load models pickled with dumps
+    :param data: bytes
+    :param api: api of the loaded models and of models parsed from them
+    :return: list of Model
+    """
+    models = pickle.loads(data)
+    for model in models:
+        model._api = api
+        user = getattr(model, 'user', None) if isinstance(
+            model, (Comment, Post)) else None
+        if isinstance(user, User):
+            user._api = api
+    return models
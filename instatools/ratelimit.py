@@ -0,0 +1,177 @@
+"""
+Token bucket rate limiting for Session requests
+"""
+from threading import Lock
+from time import monotonic, sleep, time
+import asyncio
+import math
+
+
+class TokenBucket:
+    """
+    Refills continuously at a rate of `capacity` tokens per `period` seconds
+    and holds up to `burst` tokens (defaults to `capacity`). Every request
+    takes one token.
+
+    The bucket never blocks on its own: `try_acquire` and
+    `time_until_available` let callers schedule work themselves, `reserve`
+    sets tokens aside for a batch, and `acquire` / `acquire_async` are the
+    blocking and asyncio front-ends that wait for tokens
+    """
+    def __init__(self, capacity, period, burst=None):
+        self.capacity = capacity
+        self.period = period
+        self.burst = burst or capacity
+        self.rate = capacity / period
+        self._tokens = float(self.burst)
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def __repr__(self):
+        return 'TokenBucket(tokens=%d/%d, period=%ds)' % (
+            self.tokens, self.burst, self.period)
+
+    @property
+    def tokens(self):
+        """Whole tokens available, negative while reservations are owed"""
+        with self._lock:
+            self._refill()
+            return math.floor(self._tokens)
+
+    @property
+    def next_refill(self):
+        """Unix time when the next whole token is added, None if full"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= self.burst:
+                return None
+            wait = (math.floor(self._tokens) + 1 - self._tokens) / self.rate
+            return time() + wait
+
+    def time_until_available(self, n=1):
+        """Seconds until `n` tokens can be acquired, 0 if they are now"""
+        self._check(n)
+        with self._lock:
+            self._refill()
+            return max(0., (n - self._tokens) / self.rate)
+
+    def try_acquire(self, n=1):
+        """Take `n` tokens if they are available now, without waiting"""
+        return self._take(n) == 0
+
+    def acquire(self, n=1):
+        """Take `n` tokens, blocking until they are available"""
+        wait = self._take(n)
+        while wait:
+            sleep(wait)
+            wait = self._take(n)
+
+    async def acquire_async(self, n=1):
+        """Take `n` tokens, awaiting until they are available"""
+        wait = self._take(n)
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._take(n)
+
+    def reserve(self, n):
+        """
+        Set `n` tokens aside for a batch of requests. The tokens are taken
+        immediately, even if that leaves the bucket owing tokens, so the
+        batch is served before any later request
+        :param n: int: number of tokens to reserve, can exceed `burst`
+        :return: Reservation
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= n
+            wait = max(0., -self._tokens / self.rate)
+        return Reservation(self, n, monotonic() + wait)
+
+    def _check(self, n):
+        if n > self.burst:
+            raise ValueError('Cannot take %d tokens from a bucket of %d' % (
+                n, self.burst))
+
+    def _give_back(self, n):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.burst, self._tokens + n)
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self, n):
+        """Take `n` tokens if available, otherwise return seconds to wait"""
+        self._check(n)
+        with self._lock:
+            self._refill()
+            if self._tokens >= n:
+                self._tokens -= n
+                return 0
+            return (n - self._tokens) / self.rate
+
+
+class Reservation:
+    """
+    Tokens reserved from a TokenBucket. They can be spent (`take`) once the
+    bucket has paid back what it owed when they were reserved (`ready_at`),
+    unused tokens are returned to the bucket with `cancel`
+    """
+    def __init__(self, bucket, tokens, ready_at):
+        self.bucket = bucket
+        self.tokens = tokens
+        self.ready_at = ready_at
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cancel()
+
+    def __repr__(self):
+        return 'Reservation(tokens=%d, ready_in=%.1fs)' % (
+            self.tokens, self.time_until_ready())
+
+    def time_until_ready(self):
+        return max(0., self.ready_at - monotonic())
+
+    def take(self):
+        """Spend one reserved token, False if none are left or not ready"""
+        with self._lock:
+            if self.tokens <= 0 or self.time_until_ready():
+                return False
+            self.tokens -= 1
+            return True
+
+    def wait(self):
+        """Block until the reserved tokens can be spent"""
+        sleep(self.time_until_ready())
+
+    async def wait_async(self):
+        """Await until the reserved tokens can be spent"""
+        await asyncio.sleep(self.time_until_ready())
+
+    def cancel(self):
+        """Return unused tokens to the bucket"""
+        with self._lock:
+            tokens, self.tokens = self.tokens, 0
+        if tokens:
+            self.bucket._give_back(tokens)
@@ -0,0 +1,143 @@
+"""
+Bounded stores of already seen item ids, used by feeds to drop duplicates
+"""
+from collections import OrderedDict
+from hashlib import blake2b
+from time import monotonic
+import math
+
+
+def create(kind='bloom', max_items=1000000, max_age=None, error_rate=0.001):
+    """
+    Create a seen-store
+    :param kind: str: 'bloom' (probabilistic, compact) or 'lru' (exact)
+    :param max_items: int: number of ids to remember
+    :param max_age: float: seconds to remember ids for ('lru' only)
+    :param error_rate: float: false positive rate ('bloom' only)
+    :return: LRUSeen or BloomSeen
+    """
+    if kind == 'lru':
+        return LRUSeen(max_items, max_age=max_age)
+    elif kind == 'bloom':
+        return BloomSeen(max_items, error_rate=error_rate)
+    raise ValueError('Unknown seen-store: %s' % kind)
+
+
+class LRUSeen:
+    """
+    Exact seen-store remembering the `max_items` most recently seen ids.
+    An id is seen again both when it is added and when it is found in the
+    store. With `max_age` ids are forgotten `max_age` seconds after they were
+    last seen, otherwise no time is stored with them
+    """
+    def __init__(self, max_items=1000000, max_age=None):
+        self.max_items = max_items
+        self.max_age = max_age
+        self._ids = OrderedDict()
+
+    def __contains__(self, item_id):
+        if item_id not in self._ids:
+            return False
+        if self.max_age is not None:
+            now = monotonic()
+            if now - self._ids[item_id] > self.max_age:
+                del self._ids[item_id]
+                return False
+            self._ids[item_id] = now
+        self._ids.move_to_end(item_id)
+        return True
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, item_id):
+        if self.max_age is None:
+            self._ids[item_id] = None
+        else:
+            now = monotonic()
+            self._ids[item_id] = now
+            while now - next(iter(self._ids.values())) > self.max_age:
+                self._ids.popitem(last=False)
+        self._ids.move_to_end(item_id)
+        while len(self._ids) > self.max_items:
+            self._ids.popitem(last=False)
+
+    def clear(self):
+        self._ids.clear()
+
+
+class BloomSeen:
+    """
+    Probabilistic seen-store, about 1.8MB per million ids at 0.1% false
+    positives. May report unseen ids as seen at `error_rate`, never the
+    other way around. Ids are kept in generations of Bloom filters: the
+    first holds `initial_capacity` ids and each next one twice as many, so
+    a store only takes the memory of the ids it holds, until generations
+    hold `max_items / 2` ids. From then on the oldest generation is dropped
+    when the newest is full, so at least the `max_items / 2` most recent ids
+    are remembered. Growing generations use a lower error rate, so that
+    together they stay within `error_rate`
+    """
+    def __init__(self, max_items=1000000, error_rate=0.001,
+                 initial_capacity=1024):
+        self.max_items = max_items
+        self.error_rate = error_rate
+        self._capacity = max(1, max_items // 2)
+        self._initial_capacity = min(initial_capacity, self._capacity)
+        self._growth_steps = max(1, math.ceil(math.log2(
+            self._capacity / self._initial_capacity)))
+        self.clear()
+
+    def __contains__(self, item_id):
+        h1, h2 = self._hash(item_id)
+        return self._test(self._new, h1, h2) or any(
+            self._test(old, h1, h2) for old in self._old)
+
+    def __len__(self):
+        """Approximate number of ids remembered"""
+        return self._count + sum(old[3] for old in self._old)
+
+    def add(self, item_id):
+        capacity = self._new[3]
+        if self._count >= capacity:
+            if capacity < self._capacity:
+                self._old.append(self._new)
+            else:
+                self._old = [self._new]
+            self._new = self._generation(min(2 * capacity, self._capacity))
+            self._count = 0
+        bits, n_bits, n_hashes, _ = self._new
+        h1, h2 = self._hash(item_id)
+        for i in range(n_hashes):
+            j = (h1 + i * h2) % n_bits
+            bits[j >> 3] |= 1 << (j & 7)
+        self._count += 1
+
+    def clear(self):
+        self._old = []  # full generations, oldest first
+        self._new = self._generation(self._initial_capacity)
+        self._count = 0
+
+    def _generation(self, capacity):
+        """Empty Bloom filter: [bits, number of bits, hashes, capacity]"""
+        error_rate = self.error_rate if capacity >= self._capacity else \
+            self.error_rate / self._growth_steps
+        n_bits = max(8, int(-capacity * math.log(error_rate) /
+                            math.log(2) ** 2))
+        n_hashes = max(1, round(n_bits / capacity * math.log(2)))
+        return [bytearray(n_bits // 8 + 1), n_bits, n_hashes, capacity]
+
+    @staticmethod
+    def _hash(item_id):
+        digest = blake2b(str(item_id).encode('utf-8'), digest_size=16).digest()
+        return (int.from_bytes(digest[:8], 'little'),
+                int.from_bytes(digest[8:], 'little') | 1)
+
+    @staticmethod
+    def _test(generation, h1, h2):
+        bits, n_bits, n_hashes, _ = generation
+        for i in range(n_hashes):
+            j = (h1 + i * h2) % n_bits
+            if not bits[j >> 3] & (1 << (j & 7)):
+                return False
+        return True
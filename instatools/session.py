@@ -2,18 +2,21 @@
 Instagram Session class provides bare minimum to make
 authenticated, rate_limited requests to the Instagram API
 """
+from concurrent.futures import Future
 from contextlib import contextmanager
+from contextvars import ContextVar
+from copy import deepcopy
 from datetime import datetime
 from hashlib import md5, sha256
-from threading import Lock
-from ratelimiter import RateLimiter
+from threading import BoundedSemaphore, Condition, Lock, RLock
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote, urljoin
+from .ratelimit import TokenBucket
 import calendar
 import hmac
 import json
 import logging
 import os
-import re
 import requests
 import time
 import uuid
@@ -41,7 +44,7 @@ IG_SIG_KEY = '4f8732eb9ba7d1c8e8897a75d6474d4eb3f5279137431b2aafb71fafe2abe178'
 USER_AGENT = 'Instagram 10.26.0 Android ({ver}/{rel}; 320dpi; 720x1280; ' \
              '{man}; {model}; armani; qcom; en_US)'.format(**DEVICE_SETTINGS)
 HEADERS = {
-    'Connection': 'close', 'Accept': '*/*', 'Cookie2': '$Version=1',
+    'Accept': '*/*', 'Cookie2': '$Version=1',
     'Accept-Language': 'en-US', 'User-Agent': USER_AGENT,
     'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8'}
 
@@ -83,6 +86,194 @@ def generate_uuid(typ):
     return generated_uuid if typ else generated_uuid.replace('-', '')
 
 
+# Endpoints rate limited separately from the bulk of (read) requests
+LOGIN_ENDPOINTS = {'login_challenge', 'login', 'logout'}
+UPLOAD_ENDPOINTS = {'change_profile_picture', 'configure', 'create_post',
+                    'expose', 'upload_photo', 'upload_video'}
+WRITE_ENDPOINTS = {
+    'edit_profile', 'change_password', 'remove_profile_picture',
+    'set_public', 'set_private', 'set_phone_name',
+    'follow', 'unfollow', 'block', 'unblock', 'approve', 'ignore',
+    'like', 'unlike', 'comment', 'remove_comment', 'remove_post',
+    'save', 'unsave', 'remove_tag',
+    'direct_link', 'direct_message', 'direct_share'}
+
+# Rate limit reservations active in the current thread or task, per session
+_reservations = ContextVar('reservations', default={})
+
+
+def endpoint_class(path):
+    """Rate limit class of an api path name: login/upload/write/read"""
+    if path in LOGIN_ENDPOINTS:
+        return 'login'
+    elif path in UPLOAD_ENDPOINTS:
+        return 'upload'
+    elif path in WRITE_ENDPOINTS:
+        return 'write'
+    return 'read'
+
+
+def _check_json(resp):
+    """Raise requests.HTTPError if a response is an error or not json"""
+    content_type = resp.headers.get('Content-Type', 'application/json')
+    try:
+        resp.raise_for_status()
+        if 'json' not in content_type:
+            raise requests.HTTPError(
+                'Expected a json response, got %s' % content_type,
+                response=resp)
+    except requests.HTTPError:
+        resp.close()
+        raise
+
+
+def _pool_name(scheme, host, port):
+    return '%s://%s:%s' % (scheme, host, port)
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    Transport adapter that keeps connections alive between requests.
+    Pools that have not been used for `idle_timeout` seconds are closed, and
+    connection reuse is counted per pool: a hit is a request sent over an
+    already open connection, a miss is a request that had to open a new one
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10,
+                 idle_timeout=60, **kwargs):
+        self.idle_timeout = idle_timeout
+        self._last_used = {}
+        self._retired = {}
+        self._stats_lock = Lock()
+        super().__init__(pool_connections=pool_connections,
+                         pool_maxsize=pool_maxsize, **kwargs)
+
+    @property
+    def stats(self):
+        """Hit/miss counters of every pool this adapter has opened"""
+        with self._stats_lock:
+            counts = {k: list(v) for k, v in self._retired.items()}
+        for pool in self._open_pools():
+            name = _pool_name(pool.scheme, pool.host, pool.port)
+            hits, misses = counts.setdefault(name, [0, 0])
+            counts[name] = [hits + pool.num_requests - pool.num_connections,
+                            misses + pool.num_connections]
+        return {name: {'hits': hits, 'misses': misses}
+                for name, (hits, misses) in counts.items()}
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self._track(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        is_new = proxy not in self.proxy_manager
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if is_new:
+            self._track(manager)
+        return manager
+
+    def get_connection(self, *args, **kwargs):
+        return self._used(super().get_connection(*args, **kwargs))
+
+    def get_connection_with_tls_context(self, *args, **kwargs):
+        return self._used(
+            super().get_connection_with_tls_context(*args, **kwargs))
+
+    def send(self, request, **kwargs):
+        self.close_idle()
+        return super().send(request, **kwargs)
+
+    def close_idle(self):
+        """Close pools that have been idle for longer than `idle_timeout`"""
+        if not self.idle_timeout:
+            return
+        now = time.monotonic()
+        for manager in self._managers():
+            with manager.pools.lock:
+                pools = list(manager.pools._container.items())
+            for key, pool in pools:
+                name = _pool_name(pool.scheme, pool.host, pool.port)
+                if now - self._last_used.get(name, now) > self.idle_timeout:
+                    manager.pools.pop(key, None)
+
+    def _managers(self):
+        return [self.poolmanager] + list(self.proxy_manager.values())
+
+    def _open_pools(self):
+        for manager in self._managers():
+            with manager.pools.lock:
+                pools = list(manager.pools._container.values())
+            for pool in pools:
+                yield pool
+
+    def _retire(self, pool):
+        # Keep the counters of pools that are closed or evicted
+        name = _pool_name(pool.scheme, pool.host, pool.port)
+        with self._stats_lock:
+            hits, misses = self._retired.get(name, (0, 0))
+            self._retired[name] = (
+                hits + pool.num_requests - pool.num_connections,
+                misses + pool.num_connections)
+
+    def _used(self, pool):
+        # Keyed by the pool serving the request, which is the proxy's pool
+        # for plain http requests through a proxy
+        self._last_used[_pool_name(pool.scheme, pool.host, pool.port)] = \
+            time.monotonic()
+        return pool
+
+    def _track(self, manager):
+        dispose = manager.pools.dispose_func
+
+        def retire_and_dispose(pool):
+            self._retire(pool)
+            if dispose:
+                dispose(pool)
+
+        manager.pools.dispose_func = retire_and_dispose
+
+
+class RequestGate:
+    """
+    Lets any number of requests through concurrently until it is held with
+    `with gate:`, which waits for requests in flight to finish and keeps new
+    requests waiting until it is released (e.g. while switching accounts)
+    """
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._active = 0
+        self._held = False
+
+    def __enter__(self):
+        with self._cond:
+            while self._held:
+                self._cond.wait()
+            self._held = True
+            while self._active:
+                self._cond.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._cond:
+            self._held = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def passage(self):
+        """Context for a single request, waits while the gate is held"""
+        with self._cond:
+            while self._held:
+                self._cond.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                if not self._active:
+                    self._cond.notify_all()
+
+
 class Session:
     """
     Class representing the request-making Session of a single Instagram user
@@ -178,38 +369,85 @@ class Session:
         'megaphone': 'megaphone/log',
         'autocomplete_users': 'friendships/autocomplete_user_list'
     }
+    # Computed once so finding the limiter of a request is a dict lookup
+    endpoint_classes = {path: endpoint_class(path) for path in paths}
+    # Requests allowed per period (seconds) for each class of endpoint
+    rate_limits = {
+        'login': (100, 3600),
+        'write': (60, 3600),
+        'upload': (30, 3600),
+        'read': (5000, 3600)
+    }
+
+    def __init__(self, username=None, password=None, session=None, *,
+                 keep_alive=True, pool_connections=10, pool_maxsize=10,
+                 idle_timeout=60, max_in_flight=10, single_flight=True):
+
+        # Only cookie/token state is locked, requests themselves run
+        # concurrently up to `max_in_flight` at a time
+        self._state_lock = RLock()
+        # Identical reads made at the same time share one request
+        self.single_flight = single_flight
+        self._flights = {}  # key: [future of the response, number joined]
+        self._flights_lock = Lock()
+        self._flight_counts = [0, 0]  # requests sent, requests shared
+        self.keep_alive = keep_alive
+        self._pool_options = {
+            'pool_connections': pool_connections,  # number of host pools
+            'pool_maxsize': pool_maxsize,  # kept-alive connections per host
+            'idle_timeout': idle_timeout
+        }
+        self._init_transport(max_in_flight)
 
-    def __init__(self, username=None, password=None, session=None):
+        self.setup(username, password, session)
+
+        self.logger = _make_logger(self.username)
+        self.limits = self._default_limits()
+
+    def _init_transport(self, max_in_flight):
+        """Create the http session that requests are sent with"""
+        self._in_flight = BoundedSemaphore(max_in_flight)
+        self.hold_requests = RequestGate()
 
         self._session = self._session_class()
         self._session.headers.update(HEADERS)
+        self._adapter = None
+        self._mount_adapter()
 
-        self.setup(username, password, session)
+    def _default_limits(self):
+        return {name: TokenBucket(*limit)
+                for name, limit in self.rate_limits.items()}
 
-        self.logger = _make_logger(self.username)
-        self.hold_requests = Lock()
-        self._mutex = Lock()
-
-        # todo add path regex
-        self.limits = {
-            'a': RateLimiter(100, 3600),  # login/logout
-            'b': RateLimiter(60, 3600),  # like/follow/comment
-            '.*': RateLimiter(5000, 3600)  # all other requests
-        }
+    @property
+    def pool_stats(self):
+        """Connection reuse counters per pool, empty without keep-alive"""
+        return self._adapter.stats if self._adapter else {}
+
+    @property
+    def flight_stats(self):
+        """
+        Counters of single-flight reads: `sent` requests were made, and
+        `shared` requests were answered by an identical one in flight
+        """
+        with self._flights_lock:
+            sent, shared = self._flight_counts
+        return {'sent': sent, 'shared': shared}
 
     @property
     def rank_token(self):
-        return "%s_%s" % (self.username_id, self.uuid)
+        with self._state_lock:
+            return "%s_%s" % (self.username_id, self.uuid)
 
     @property
     def session_data(self):
-        return {
-            'device_id': self.device_id,
-            'uid': self.username_id,
-            'uuid': self.uuid,
-            'token': self.token,
-            'cookies': self._cookies
-        }
+        with self._state_lock:
+            return {
+                'device_id': self.device_id,
+                'uid': self.username_id,
+                'uuid': self.uuid,
+                'token': self.token,
+                'cookies': self._cookies
+            }
 
     def login_data(self, cookies):
         """
@@ -236,11 +474,8 @@ class Session:
 
         # Get login challenge
         resp = self.request('GET', self.url('login_challenge'),
-                            return_json=False,
-                            params={
-                                'challenge_type': 'signup',
-                                'guid': generate_uuid(False)
-                            })
+                            endpoint='login_challenge', return_json=False,
+                            params=self._login_challenge_params())
         if resp.status_code != 200:
             self.logger.error('Requesting login challenge failed')
             return False
@@ -248,21 +483,30 @@ class Session:
         self.logger.debug('Successfully requested login challenge url')
         # Attempt to login with cookies from challenge
         resp = self.request('POST', self.url('login'),
-                            return_json=False,
+                            endpoint='login', return_json=False,
                             data=self.login_data(resp.cookies))
+        return self._on_login(resp)
+
+    @staticmethod
+    def _login_challenge_params():
+        return {'challenge_type': 'signup', 'guid': generate_uuid(False)}
 
+    def _on_login(self, resp):
+        """Store session state from the response to the login POST"""
         if resp.status_code != 200:
             self.logger.error('Login POST failed')
             return False
 
         self.logger.debug('Successfully POSTED to login url')
-        self._cookies = {ck.name: ck.value for ck in resp.cookies}
-
-        # Set user data to response data if successful
         data = resp.json()
+        with self._state_lock:
+            self._cookies = {ck.name: ck.value for ck in resp.cookies}
+            # Set user data to response data if successful
+            if 'logged_in_user' in data:
+                self.username_id = data["logged_in_user"]["pk"]
+                self.token = self._cookies["csrftoken"]
+
         if 'logged_in_user' in data:
-            self.username_id = data["logged_in_user"]["pk"]
-            self.token = self._cookies["csrftoken"]
             self.logger.info('Login success')
             return data['logged_in_user']
         self.logger.info('Login failed')
@@ -270,9 +514,14 @@ class Session:
 
     def logout(self):
         """Logout of currently logged-in account"""
-        resp = self.request('GET', self.url('logout'), return_json=False)
+        resp = self.request('GET', self.url('logout'), endpoint='logout',
+                            return_json=False)
+        return self._on_logout(resp)
+
+    def _on_logout(self, resp):
         if resp.status_code == 200:
-            self.token = None
+            with self._state_lock:
+                self.token = None
             self.logger.info('Logged out')
             return True
         self.logger.error('Logout failed')
@@ -283,39 +532,124 @@ class Session:
         self.setup(username, password, session)
         self.logger.info('Switching to user %s', self.username)
 
-    def request(self, method, url, *,
-                params=None, data=None, return_json=True, **kwargs):
+    def request(self, method, url, *, endpoint=None,
+                params=None, data=None, return_json=True, check_json=False,
+                **kwargs):
         """
 
         :param method:
         :param url:
+        :param endpoint: name of the api path in `paths` used for the url,
+            requests without one are rate limited as reads
         :param params:
         :param data:
         :param return_json:
+        :param check_json: raise requests.HTTPError if a response returned
+            without being decoded (e.g. streamed) is an error or not json
         :param kwargs:
         :return:
         """
+        # Request patching for specific endpoints
+        params, data = self.sign(method, url, params, data)
+        kwargs.update(params=params, data=data)
+        # Wait until allowed to request given url
+        with self.wait_limit(endpoint):
+            with self._in_flight:
+                resp = self._session.request(method, url, **kwargs)
+
+        if return_json:
+            return resp.json()
+        if check_json:
+            _check_json(resp)
+        return resp
+
+    def sign(self, method, url, params=None, data=None):
+        """
+        Add session tokens to friendship GET params and sign POST data
+        :param method:
+        :param url:
+        :param params:
+        :param data:
+        :return: tuple: params and data to send
+        """
         if method == 'GET' and 'friendship' in url:
             params = params or {}
             params.update(ig_sig_key_version=4, rank_token=self.rank_token)
 
         elif method == 'POST' and isinstance(data, dict):
             dct = data.copy()
-            dct.update(_uuid=self.uuid, _uid=self.username_id,
-                       _csrftoken=self.token)
+            with self._state_lock:
+                dct.update(_uuid=self.uuid, _uid=self.username_id,
+                           _csrftoken=self.token)
             data = generate_signature(json.dumps(dct))
 
-        # Request patching for specific endpoints
-        kwargs.update(params=params, data=data)
-        # Wait until allowed to request given url
-        with self.wait_limit(url):
-            # Yay thread safety!
-            with self._mutex:
-                resp = self._session.request(method, url, **kwargs)
-
-        return resp.json() if return_json else resp
+        return params, data
 
     def request_safely(self, *args, max_attempts=0, **kwargs):
+        """
+        Make a safe request that returns correct results or dies trying, see
+        _request_safely. With `single_flight`, a read made while an identical
+        one (same method, url and params) is in flight waits for it and
+        returns a copy of its response instead of making another request
+        """
+        key = self._flight_key(args, kwargs)
+        if key is None:
+            return self._request_safely(
+                *args, max_attempts=max_attempts, **kwargs)
+
+        flight, joined = self._join_flight(key, Future)
+        if joined:
+            return deepcopy(flight.result())
+        try:
+            resp = self._request_safely(
+                *args, max_attempts=max_attempts, **kwargs)
+        except BaseException as e:
+            if self._land_flight(key):
+                flight.set_exception(e)
+            raise
+        if self._land_flight(key):
+            flight.set_result(deepcopy(resp))
+        return resp
+
+    def _flight_key(self, args, kwargs):
+        """Key of identical requests, None if the request is not shared"""
+        endpoint = kwargs.get('endpoint')
+        if not self.single_flight or endpoint_class(endpoint) != 'read' or \
+                not kwargs.get('return_json', True) or kwargs.get('stream'):
+            return None
+        method, url = args
+        return method, url, json.dumps(kwargs.get('params'), sort_keys=True,
+                                       default=str)
+
+    def _join_flight(self, key, future_class):
+        """
+        Flight of a request, and whether it was already in flight
+        :return: tuple: future of the response, bool
+        """
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            joined = flight is not None
+            if joined:
+                flight[1] += 1
+            else:
+                flight = self._flights[key] = [future_class(), 0]
+            self._flight_counts[joined] += 1
+        return flight[0], joined
+
+    def _land_flight(self, key, abandoned=False):
+        """
+        End the flight of a request
+        :param abandoned: bool: the request was given up without a response,
+            the requests that joined it are made again and counted then
+        :return: bool: whether other requests joined it
+        """
+        with self._flights_lock:
+            joined = self._flights.pop(key)[1]
+            if abandoned:
+                self._flight_counts[1] -= joined
+        return joined > 0
+
+    def _request_safely(self, *args, max_attempts=0, **kwargs):
         """
         Make a safe request that returns correct results or dies trying!
         Keeps requesting with exponential back-off until `requests_to_break` is
@@ -334,12 +668,12 @@ class Session:
 
         while True:
             try:
-                with self.hold_requests:
+                with self.hold_requests.passage():
                     resp = self.request(*args, **kwargs)
                 return resp
             except requests.HTTPError as e:
                 self.logger.error('Error %d - %s %s ',
-                                  e.request.status_code, args[0], args[1])
+                                  e.response.status_code, args[0], args[1])
 
             except json.JSONDecodeError:
                 self.logger.error('Response not in JSON format: %s - %s',
@@ -381,24 +715,25 @@ class Session:
         """
 
         self._assert_session_data_correct(username, password, session)
-        self.password = password
-
-        if session:
-            self._cookies = session.get('cookies')
-            self.username = self._cookies['ds_user']
-            self.device_id = session.get('device_id')
-            self.username_id = session.get('uid')
-            self.uuid = session.get('uuid')
-            self.token = session.get('token')
-            self._session.cookies.update(self._cookies)
-        else:
-            self._cookies = None
-            self.username = username
-            h = md5((username + password).encode('utf-8')).hexdigest()
-            self.device_id = generate_device_id(h)
-            self.username_id = None
-            self.uuid = generate_uuid(True)
-            self.token = None
+        with self._state_lock:
+            self.password = password
+
+            if session:
+                self._cookies = session.get('cookies')
+                self.username = self._cookies['ds_user']
+                self.device_id = session.get('device_id')
+                self.username_id = session.get('uid')
+                self.uuid = session.get('uuid')
+                self.token = session.get('token')
+                self._load_cookies(self._cookies)
+            else:
+                self._cookies = None
+                self.username = username
+                h = md5((username + password).encode('utf-8')).hexdigest()
+                self.device_id = generate_device_id(h)
+                self.username_id = None
+                self.uuid = generate_uuid(True)
+                self.token = None
 
     def set_proxy(self, proxy):
         """
@@ -408,25 +743,75 @@ class Session:
         self._session.proxies.update({
             'http': 'http://' + proxy, 'https': 'http://' + proxy
         })
+        # Kept-alive connections were opened without the new proxy
+        if self._adapter:
+            self._adapter.close()
+
+    def _load_cookies(self, cookies):
+        self._session.cookies.update(cookies)
 
     def url(self, path, *args):
         """Return url for api path formatted with args"""
         return urljoin(BASE_URL, self.paths[path].format(*args))
 
+    def _mount_adapter(self):
+        """Mount the transport adapter for the configured connection mode"""
+        if self.keep_alive:
+            self._adapter = PooledAdapter(**self._pool_options)
+            self._session.mount('https://', self._adapter)
+            self._session.mount('http://', self._adapter)
+            self._session.headers['Connection'] = 'keep-alive'
+        else:
+            self._session.headers['Connection'] = 'close'
+
+    def limiter_for(self, endpoint):
+        """
+        Find the rate limiter responsible for an endpoint
+        :param endpoint: str: name of api path
+        :return: TokenBucket of the endpoint's class
+        """
+        return self.limits[self.endpoint_classes.get(endpoint, 'read')]
+
     @contextmanager
-    def wait_limit(self, url):
+    def reserve(self, endpoint, n):
         """
+        Reserve rate limit quota for a batch of `n` requests to endpoints of
+        the same class as `endpoint`. Requests made from the same thread (or
+        asyncio task) inside the context spend the reservation first, and
+        unused quota is returned on exit
+        :param endpoint: str: name of api path
+        :param n: int: number of requests
+        :return: Reservation
+        """
+        name = self.endpoint_classes.get(endpoint, 'read')
+        reservation = self.limits[name].reserve(n)
+        active = dict(_reservations.get())
+        active[self] = dict(active.get(self, {}), **{name: reservation})
+        token = _reservations.set(active)
+        try:
+            yield reservation
+        finally:
+            _reservations.reset(token)
+            reservation.cancel()
+
+    def reservation_for(self, endpoint):
+        """Reservation active in the current context for an endpoint"""
+        return _reservations.get().get(self, {}).get(
+            self.endpoint_classes.get(endpoint, 'read'))
 
-        :param url:
+    @contextmanager
+    def wait_limit(self, endpoint):
+        """
+        Wait until the rate limit of the endpoint allows another request
+        :param endpoint: str: name of api path
         :return:
         """
-        for path, limiter in self.limits.items():
-            if re.search(path, url):
-                with limiter:
-                    yield
-                break
-        else:
-            yield
+        reservation = self.reservation_for(endpoint)
+        if reservation is not None:
+            reservation.wait()
+        if reservation is None or not reservation.take():
+            self.limiter_for(endpoint).acquire()
+        yield
 
     @staticmethod
     def build_form_body(bodies, boundary):
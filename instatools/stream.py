@@ -0,0 +1,117 @@
+"""
+Incremental decoding of json responses, so that the items of a large feed
+page are decoded one at a time while the body is read instead of all at once
+"""
+import codecs
+import json
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+
+
+class Page:
+    """
+    A json object decoded while it is read. Iterating it yields each element
+    of the arrays under `item_keys`, as soon as it is decoded; the values of
+    other keys (e.g. next_max_id, more_available) are collected in
+    `response` as they are reached
+    :param chunks: iterable of bytes of the body, e.g. Response.iter_content
+    :param item_keys: keys of the arrays of items
+    :param close: callable that releases the connection the body is read from
+    """
+    def __init__(self, chunks, item_keys, close=None):
+        self.item_keys = item_keys
+        self.response = {}
+        self._buffer = ''
+        self._chunks = iter(chunks)
+        self._close = close
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self._eof = False
+        self._iter = None
+        self._pos = 0
+
+    def __iter__(self):
+        if self._iter is None:
+            self._iter = self._items()
+        return self._iter
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def _items(self):
+        try:
+            self._expect('{')
+            if self._peek() == '}':
+                return
+            while True:
+                key = self._value()
+                self._expect(':')
+                if key in self.item_keys and self._peek() == '[':
+                    self._expect('[')
+                    if self._peek() == ']':
+                        self._pos += 1
+                    else:
+                        while True:
+                            yield self._value()
+                            if self._next_of(',]') == ']':
+                                break
+                else:
+                    self.response[key] = self._value()
+                if self._next_of(',}') == '}':
+                    return
+        finally:
+            self.close()
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise json.JSONDecodeError(
+                'Expecting %r' % char, self._buffer, self._pos)
+        self._pos += 1
+
+    def _fill(self):
+        """Read the next chunk of the body, False at its end"""
+        if self._eof:
+            return False
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        for chunk in self._chunks:
+            text = self._decode(chunk)
+            if text:
+                self._buffer += text
+                return True
+        self._buffer += self._decode(b'', True)
+        self._eof = True
+        return True
+
+    def _next_of(self, chars):
+        char = self._peek()
+        if char == '' or char not in chars:
+            raise json.JSONDecodeError(
+                'Expecting one of %r' % chars, self._buffer, self._pos)
+        self._pos += 1
+        return char
+
+    def _peek(self):
+        """Next character that is not whitespace, '' at the end of the body"""
+        while True:
+            while self._pos < len(self._buffer) and \
+                    self._buffer[self._pos] in _whitespace:
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may go on in the next chunk
+            if end < len(self._buffer) or not self._fill():
+                self._pos = end
+                return value
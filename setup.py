@@ -11,8 +11,9 @@ with open('README.rst') as readme_file:
 with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
-requirements = ['requests>=2.18.4', 'ratelimiter>=1.2.0',
-                'cached_property>=1.4.3', 'pillow>=5.1.0']
+requirements = ['requests>=2.18.4', 'cached_property>=1.4.3', 'pillow>=5.1.0']
+
+extra_requirements = {'async': ['aiohttp>=3.0'], 'numpy': ['numpy']}
 
 setup_requirements = ['pytest-runner', ]
 
@@ -26,16 +27,16 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
         'Natural Language :: English',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
     ],
-    description="Unofficial Instagram API for python 3.5+",
+    description="Unofficial Instagram API for python 3.7+",
     entry_points={
         'console_scripts': [
             'instatools=instatools.cli:main',
         ],
     },
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="GNU General Public License v3",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -45,6 +46,7 @@ setup(
     setup_requires=setup_requirements,
     test_suite='tests',
     tests_require=test_requirements,
+    python_requires='>=3.7',
     url='https://github.com/sentrip/instatools',
     version='0.1.8',
     zip_safe=False,
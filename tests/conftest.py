@@ -1,3 +1,7 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+import json
 import os
 import pytest
 import sys
@@ -50,3 +54,75 @@ def session():
 def record_requests():
     with instatools.cache.record('tests/data'):
         yield
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # Serve queued responses for a path in order, repeating the last one.
+        # A response is a json body, or a (status, content type, text) tuple
+        queue = self.server.responses.get(self.path.split('?')[0], [])
+        body = queue.pop(0) if len(queue) > 1 else (
+            queue[0] if queue else {'status': 'ok'})
+        status, content_type = 200, 'application/json'
+        if isinstance(body, tuple):
+            status, content_type, body = body
+            body = body.encode('utf-8')
+        else:
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        # Read the body, or it is parsed as the next kept-alive request
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class _StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.responses = {}
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+@pytest.fixture
+def stub_server():
+    server = _StubServer(('127.0.0.1', 0), _StubHandler)
+    Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stub_url(stub_server, monkeypatch):
+    """Point api urls at the stub server, without pausing between pages"""
+    monkeypatch.setattr('instatools.session.BASE_URL',
+                        stub_server.url + 'api/v1/')
+    monkeypatch.setattr('instatools.api.sleep_between_pages', 0)
+    return stub_server
+
+
+@pytest.fixture
+def stub_api(stub_url):
+    return Instagram('usr', 'pwd')
+
+
+@pytest.fixture
+def feed_pages():
+    """Builds stub responses for a feed, one page per list of post ids"""
+    def pages(*page_ids):
+        return [dict(status='ok', items=[{'pk': pk} for pk in ids],
+                     more_available=i < len(page_ids) - 1, next_max_id=str(i))
+                for i, ids in enumerate(page_ids)]
+    return pages
@@ -0,0 +1,55 @@
+import pytest
+from instatools.accounts import AccountError, AccountPool
+from instatools.models import ModelFactory
+from instatools.session import Session
+
+
+def test_jobs_run_as_owning_account(stub_url):
+    for i in range(4):
+        stub_url.responses['/api/v1/users/%d/info/' % i] = [
+            {'status': 'ok', 'user': {'pk': i, 'username': 'u%d' % i}}]
+
+    accounts = {'usr%d' % i: 'pwd' for i in range(4)}
+    with AccountPool(accounts, processes=2, login=False,
+                     context='fork') as pool:
+        assert sorted(pool.shards.values()) == [0, 0, 1, 1]
+        futures = pool.map('get_user', [('usr%d' % i, (i,))
+                                        for i in range(4)])
+        users = [f.result(timeout=10) for f in futures]
+
+    assert [user.id for user in users] == [0, 1, 2, 3]
+    assert all(isinstance(user, ModelFactory.user) for user in users)
+    stats = pool.stats()
+    assert stats['usr0']['done'] == 1
+    assert stats['usr0']['queued'] == 0
+    reads = Session.rate_limits['read'][0]
+    assert stats['usr0']['limits']['read'] == reads - 1
+
+
+def test_feed_jobs_and_failures(stub_url):
+    stub_url.responses['/api/v1/feed/tag/beach/'] = [
+        {'status': 'ok', 'items': [{'pk': i} for i in range(5)],
+         'more_available': False}]
+
+    with AccountPool({'usr': 'pwd'}, login=False, context='fork') as pool:
+        posts = pool.submit('usr', 'feed', 'tag_feed', 'beach', limit=3)
+        missing = pool.submit('usr', 'not_a_method')
+        assert [post.id for post in posts.result(timeout=10)] == [0, 1, 2]
+        with pytest.raises(AccountError):
+            missing.result(timeout=10)
+
+    assert pool.stats()['usr']['failed'] == 1
+
+
+def test_jobs_fail_when_account_cannot_login(monkeypatch):
+    monkeypatch.setattr('instatools.session.BASE_URL',
+                        'http://127.0.0.1:1/api/v1/')
+
+    with AccountPool({'usr': 'pwd'}, context='fork') as pool:
+        with pytest.raises(ValueError):
+            pool.submit('unknown', 'get_user', 1)
+        with pytest.raises(AccountError):
+            pool.submit('usr', 'get_user', 1).result(timeout=10)
+
+    assert pool.stats()['usr']['failed'] == 1
+    assert pool.stats()['usr']['queued'] == 0
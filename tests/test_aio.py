@@ -0,0 +1,152 @@
+import asyncio
+import pytest
+from instatools.models import ModelFactory
+
+pytest.importorskip('aiohttp')
+from instatools.aio import AsyncInstagram, _AsyncPages  # noqa: E402
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def async_api(stub_url):
+    return AsyncInstagram('usr', 'pwd')
+
+
+def test_async_action(async_api, stub_server):
+    stub_server.responses['/api/v1/users/1/info/'] = [
+        {'status': 'ok', 'user': {'pk': 1, 'username': 'usr'}}]
+
+    async def get_user():
+        async with async_api:
+            return await async_api.get_user(1)
+
+    user = run(get_user())
+    assert isinstance(user, ModelFactory.user)
+    assert user.id == 1
+
+
+def test_async_feed(async_api, stub_server, feed_pages):
+    stub_server.responses['/api/v1/feed/tag/beach/'] = feed_pages(
+        [1, 2], [3], [4, 5])
+
+    async def read_feed():
+        async with async_api:
+            feed = async_api.api_method().feed('tag_feed', 'beach')
+            assert isinstance(feed, _AsyncPages)
+            return [post.id async for post in feed]
+
+    assert run(read_feed()) == [1, 2, 3, 4, 5]
+
+
+def test_async_feed_batch(async_api, stub_server, feed_pages):
+    stub_server.responses['/api/v1/feed/tag/beach/'] = feed_pages(
+        [1, 2], [3])
+
+    async def read_batch():
+        async with async_api:
+            feed = async_api.api_method().feed('tag_feed', 'beach')
+            return await feed.batch(['id'])
+
+    assert list(run(read_batch())['id']) == [1, 2, 3]
+
+
+def test_async_feeds_share_one_loop(async_api, stub_server, feed_pages):
+    for tag in range(50):
+        stub_server.responses['/api/v1/feed/tag/%d/' % tag] = feed_pages(
+            [tag])
+
+    async def read_feed(tag):
+        return [post.id async for post in
+                async_api.api_method().feed('tag_feed', tag)]
+
+    async def read_feeds():
+        async with async_api:
+            return await asyncio.gather(*map(read_feed, range(50)))
+
+    assert run(read_feeds()) == [[tag] for tag in range(50)]
+
+
+def test_async_feed_is_not_iterable(async_api):
+    with pytest.raises(TypeError):
+        list(async_api.api_method().feed('tag_feed', 'beach'))
+    with pytest.raises(TypeError):
+        list(async_api.feeds.tag('beach'))
+
+
+def test_async_model_properties(async_api, stub_server):
+    stub_server.responses['/api/v1/media/1/comments/'] = [
+        {'status': 'ok', 'comments': [{'pk': 10, 'media_id': 1}]}]
+    stub_server.responses['/api/v1/friendships/2/followers'] = [
+        {'status': 'ok', 'users': [{'pk': 3}, {'pk': 4}]}]
+    stub_server.responses['/api/v1/media/1/info/'] = [
+        {'status': 'ok', 'items': [{'pk': 1, 'user': {'pk': 2}}]}]
+
+    async def read_properties():
+        async with async_api:
+            post = await async_api.get_post(1)
+            comments = [c.id for c in await post.comments]
+            assert [c.id for c in await post.comments] == comments
+            followers = [u.id for u in await post.user.followers]
+            assert [u.id for u in await post.user.followers] == followers
+            return comments, followers
+
+    assert run(read_properties()) == ([10], [3, 4])
+
+
+def test_async_session_options(stub_url):
+    api = AsyncInstagram('usr', 'pwd', keep_alive=False, pool_maxsize=2)
+
+    async def get_user():
+        async with api:
+            connector = api.session._client().connector
+            assert connector.force_close
+            assert connector.limit_per_host == 2
+            return await api.get_user(1)
+
+    assert run(get_user())
+
+
+def test_async_single_flight(async_api, stub_server):
+    stub_server.responses['/api/v1/users/1/info/'] = [
+        {'status': 'ok', 'user': {'pk': 1}}]
+
+    async def get_users():
+        async with async_api:
+            return await asyncio.gather(
+                async_api.get_user(1), async_api.get_user(1))
+
+    assert [user.id for user in run(get_users())] == [1, 1]
+    assert async_api.session.flight_stats == {'sent': 1, 'shared': 1}
+
+
+def test_async_single_flight_leader_cancelled(async_api, stub_server):
+    stub_server.responses['/api/v1/users/1/info/'] = [
+        {'status': 'ok', 'user': {'pk': 1}}]
+    request = async_api.session._request_safely
+
+    async def slow_request(*args, **kwargs):
+        await asyncio.sleep(0.1)
+        return await request(*args, **kwargs)
+    async_api.session._request_safely = slow_request
+
+    async def joined_get_user():
+        await asyncio.sleep(0.01)
+        return await async_api.get_user(1)
+
+    async def get_users():
+        async with async_api:
+            return await asyncio.gather(
+                asyncio.wait_for(async_api.get_user(1), 0.05),
+                joined_get_user(), return_exceptions=True)
+
+    timed_out, user = run(get_users())
+    assert isinstance(timed_out, asyncio.TimeoutError)
+    assert user.id == 1
+    assert async_api.session.flight_stats == {'sent': 2, 'shared': 0}
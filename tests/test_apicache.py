@@ -0,0 +1,42 @@
+from instatools.apicache import ResponseCache
+from instatools.instagram import Instagram
+
+
+def test_response_cache_hits_and_invalidation(stub_url):
+    stub_url.responses['/api/v1/friendships/show/7/'] = [
+        {'status': 'ok', 'friendship_status': {'following': following}}
+        for following in [False, True]]
+    api = Instagram('usr', 'pwd', response_cache=ResponseCache())
+    assert not api.get_friendship(7).following
+    assert not api.get_friendship(7).following
+    assert api.response_cache.stats == {
+        'friendship': {'hits': 1, 'misses': 1}}
+    api.follow(7)
+    assert api.get_friendship(7).following
+    assert api.response_cache.stats['friendship']['misses'] == 2
+
+
+def test_response_cache_ttl_and_lru(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('instatools.apicache.time', lambda: now[0])
+    cache = ResponseCache(ttls={'user': 10}, maxsize=2)
+    for pk in [1, 2, 3]:
+        cache.set('usr', 'user', (pk,), {'status': 'ok', 'user': {'pk': pk}})
+    assert cache.get('usr', 'user', (1,)) is None
+    assert cache.get('usr', 'user', (3,))['user'] == {'pk': 3}
+    assert not cache.cacheable('timeline')
+    assert not cache.cacheable('user', params={'a': 1})
+    now[0] += 10
+    assert cache.get('usr', 'user', (3,)) is None
+
+
+def test_response_cache_database(tmpdir):
+    path = str(tmpdir.join('responses.db'))
+    with ResponseCache(path=path) as cache:
+        cache.set('usr', 'post', ('1_2',), {'status': 'ok', 'items': []})
+    with ResponseCache(path=path) as cache:
+        assert cache.get('usr', 'post', ('1_2',)) == {
+            'status': 'ok', 'items': []}
+        cache.invalidate('usr', 'like', ('1_2',))
+    with ResponseCache(path=path) as cache:
+        assert cache.get('usr', 'post', ('1_2',)) is None
@@ -0,0 +1,60 @@
+import pickle
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from instatools.cache import (
+    DataBaseCache, Recorder, decode_response, encode_response, request_key)
+
+
+def test_database_cache_lookup(tmpdir):
+    cache = DataBaseCache(str(tmpdir.join('cache.db')),
+                          default_factories={'/api/': b'default'})
+    cache.set('https://i.instagram.com/api/v1/feed/tag/a/?max_id=1', b'1')
+    cache.set('https://i.instagram.com/api/v1/feed/tag/a/?max_id=1', b'2')
+    cache.set('https://i.instagram.com/api/v1/feed/tag/b/', b'3')
+    url = 'https://i.instagram.com/api/v1/feed/tag/a/?max_id=1'
+    assert [cache.get(url) for _ in range(3)] == [b'1', b'2', b'1']
+    assert cache.get('https://i.instagram.com/api/v1/feed/tag/b') == b'3'
+    assert cache.get('https://i.instagram.com/api/v1/feed/user/') == \
+        b'default'
+    assert cache.get('https://www.instagram.com/') is None
+    cache.delete('https://i.instagram.com/api/v1/feed/tag/b/')
+    assert cache.get('https://i.instagram.com/api/v1/feed/tag/b') == \
+        b'default'
+
+
+def test_recorder_upserts_requests(tmpdir):
+    path = str(tmpdir.join('cache.db'))
+    url = 'https://i.instagram.com/api/v1/feed/timeline'
+    recorder = Recorder(path, max_queued=2, batch_size=2)
+    for page, value in [(1, b'1'), (2, b'2'), (1, b'3')]:
+        recorder.put(url, value, request_key('get', url, {'max_id': page}))
+    recorder.flush()
+    recorder.put(url, b'4', request_key('post', url, {'max_id': 1}))
+    recorder.close()
+    assert request_key('get', url, {'max_id': 1}) == \
+        'GET https://i.instagram.com/api/v1/feed/timeline?max_id=1'
+    cache = DataBaseCache(path)
+    assert [cache.get(url) for _ in range(3)] == [b'3', b'2', b'4']
+    assert cache.conn.execute('pragma journal_mode').fetchone()[0] == 'wal'
+
+
+def test_response_record_round_trip():
+    resp = requests.Response()
+    resp.status_code = 200
+    resp.url = 'https://i.instagram.com/api/v1/feed/timeline'
+    resp.encoding = 'utf-8'
+    resp.headers = CaseInsensitiveDict({'Content-Type': 'application/json',
+                                        'Content-Length': '15'})
+    resp.cookies.set('csrftoken', 'abc', domain='.instagram.com')
+    resp._content = b'{"status":"ok"}'
+    for record in [encode_response(resp), pickle.dumps(resp)]:
+        replayed = decode_response(record)
+        assert replayed.status_code == 200
+        assert replayed.url == resp.url
+        assert replayed.json() == {'status': 'ok'}
+        assert replayed.headers['content-type'] == 'application/json'
+        assert replayed.cookies['csrftoken'] == 'abc'
+    assert 'Content-Length' not in \
+        decode_response(encode_response(resp)).headers
@@ -0,0 +1,191 @@
+from time import time
+import pytest
+from instatools import seen
+from instatools.instagram.feeds import (
+    FeedReader, FeedScheduler, _poll_interval)
+from instatools.models import ModelFactory
+
+
+def _tag_posts(stub_server, *posts):
+    stub_server.responses['/api/v1/feed/tag/beach/'] = [
+        {'status': 'ok', 'items': list(posts), 'more_available': False}]
+
+
+def test_feed_filters_raw_items(stub_api, stub_server, monkeypatch):
+    _tag_posts(stub_server, {'pk': 1, 'taken_at': 100},
+               {'pk': 2, 'taken_at': 200}, {'pk': 3, 'taken_at': 300},
+               {'pk': 4, 'taken_at': 400, 'like_count': 0})
+    parsed = []
+    parse_list = ModelFactory.post.parse_list
+
+    def counting_parse_list(api, items, extra=None):
+        parsed.extend(item['pk'] for item in items)
+        return parse_list(api, items, extra)
+
+    monkeypatch.setattr(ModelFactory.post, 'parse_list', counting_parse_list)
+
+    feed = stub_api.api_method().feed(
+        'tag_feed', 'beach', exclude={3}, taken_after=200,
+        where=lambda item: item.get('like_count', 1))
+    assert [post.id for post in feed] == [2]
+    assert parsed == [2]
+
+
+def test_page_items_are_parsed_once(stub_api, stub_server):
+    _tag_posts(stub_server, {'pk': 1}, {'pk': 2})
+    page = stub_api.api_method().feed('tag_feed', 'beach').next()
+    assert [post.id for post in page.items] == [1, 2]
+    assert page.items is page.items
+    assert page.filter(lambda item: item['pk'] > 1).items[0].id == 2
+
+
+def _timed_pages(*pages):
+    return [dict(status='ok', items=[{'pk': t, 'taken_at': t} for t in page],
+                 more_available=True, next_max_id=str(i))
+            for i, page in enumerate(pages)]
+
+
+def test_feed_stops_at_page_older_than_watermark(stub_api, stub_server):
+    pages = _timed_pages([600, 500], [400, 200], [150, 100], [50])
+    stub_server.responses['/api/v1/feed/tag/beach/'] = pages
+    feed = stub_api.api_method().feed('tag_feed', 'beach', since=250)
+    assert [post.id for post in feed] == [600, 500, 400]
+    assert stub_server.responses['/api/v1/feed/tag/beach/'] == pages[-1:]
+
+
+def test_feed_since_id(stub_api, stub_server):
+    pages = _timed_pages([600, 500], [400, 200], [50])
+    stub_server.responses['/api/v1/feed/tag/beach/'] = pages
+    feed = stub_api.api_method().feed('tag_feed', 'beach', since_id=500,
+                                      raw=True)
+    assert [item['pk'] for item in feed] == [600]
+    assert stub_server.responses['/api/v1/feed/tag/beach/'] == pages[-1:]
+
+
+def test_feed_reader_keeps_watermark(stub_api, stub_server, monkeypatch):
+    monkeypatch.setattr(FeedReader, '_sleep_between_reads', 0)
+    pages = _timed_pages([300, 200], [400, 300])
+    pages[0]['more_available'] = False
+    stub_server.responses['/api/v1/feed/user/5/'] = pages
+    reader = stub_api.feed_reader('user_feed', 5, reset_after=float('inf'))
+    assert [next(reader).id for _ in range(3)] == [300, 200, 400]
+    assert reader.since == 300
+
+
+def test_feed_reader_without_watermark(stub_api, stub_server):
+    # liked posts are ordered by when they were liked, not taken
+    pages = _timed_pages([300], [100, 300])
+    for page in pages:
+        page['more_available'] = False
+    stub_server.responses['/api/v1/feed/liked'] = pages
+    reader = stub_api.feed_reader('liked', reset_after=float('inf'))
+    assert [post.id for post in reader.poll()] == [300]
+    assert [post.id for post in reader.poll()] == [100]
+    assert reader.since is None
+
+
+def test_feed_max_age(stub_api, stub_server, monkeypatch):
+    day = 86400
+    clock = []
+    monkeypatch.setattr('instatools.api.timestamp',
+                        lambda: clock.append(1) or 10 * day)
+    pages = _timed_pages([10 * day, 8 * day + 1], [7 * day + 1, 6 * day],
+                         [5 * day])
+    stub_server.responses['/api/v1/feed/tag/beach/'] = pages
+    feed = stub_api.api_method().feed('tag_feed', 'beach', max_age=3 * day)
+    assert [post.id for post in feed] == [10 * day, 8 * day + 1, 7 * day + 1]
+    assert stub_server.responses['/api/v1/feed/tag/beach/'] == pages[-1:]
+    assert len(clock) == 4  # once for the feed, once per page
+
+
+def test_feed_reader_skips_old_posts(stub_api, stub_server):
+    now = int(time())
+    _tag_posts(stub_server, {'pk': 1, 'taken_at': now - 3600},
+               {'pk': 2, 'taken_at': now - 2 * 86400 - 3600})
+    reader = stub_api.feeds.tag('beach')
+    assert reader.reset_after == 86400
+    assert [post.id for post in reader.poll()] == [1]
+
+
+def test_feed_reader_reads_old_liked_posts(stub_api, stub_server):
+    now = int(time())
+    pages = _timed_pages([now - 3 * 86400], [now - 3600])
+    pages[-1]['more_available'] = False
+    stub_server.responses['/api/v1/feed/liked'] = pages
+    reader = stub_api.feeds.liked
+    assert [post.id for post in reader.poll()] == [
+        now - 3 * 86400, now - 3600]
+
+
+def test_poll_interval_bounds():
+    assert _poll_interval(None, 10, 100, 0) == 10
+    assert _poll_interval(0, 10, 100, 0) == 100
+    assert _poll_interval(1000, 10, 100, 0) == 10
+    assert _poll_interval(0.5, 10, 100, 0) == 20
+    assert 18 <= _poll_interval(0.5, 10, 100, 0.1) <= 22
+
+
+def _tag_pages(stub_server, tag, *pages):
+    stub_server.responses['/api/v1/feed/tag/%s/' % tag] = [
+        dict(status='ok', more_available=False,
+             items=[{'pk': pk, 'taken_at': int(time())} for pk in page])
+        for page in pages]
+
+
+def test_scheduler_polls_busy_feeds_first(stub_api, stub_server):
+    _tag_pages(stub_server, 'busy', [1, 2], [3, 4], [5, 6])
+    _tag_pages(stub_server, 'quiet', [1])
+    quiet, busy = stub_api.feeds.tag('quiet'), stub_api.feeds.tag('busy')
+    scheduler = FeedScheduler([quiet, busy], min_interval=0,
+                              max_interval=0, jitter=0)
+
+    polled = [scheduler.poll() for _ in range(5)]
+    assert [reader for reader, _ in polled] == [
+        quiet, busy, quiet, busy, busy]
+    assert [[post.id for post in items] for _, items in polled] == [
+        [1], [1, 2], [], [3, 4], [5, 6]]
+    assert busy.rate > quiet.rate == 0
+
+
+def test_scheduler_keeps_rate_limit_budget(stub_api, stub_server):
+    _tag_pages(stub_server, 'beach', [1])
+    scheduler = FeedScheduler([stub_api.feeds.tag('beach')], budget=0.5)
+    reads = stub_api.session.limits['read']
+    reads.reserve(reads.burst // 2 + 1)
+    assert scheduler.poll() == (None, [])
+    assert scheduler.time_until_next_poll() > 0
+
+
+def _batch_pages():
+    return [dict(status='ok', more_available=i < 1, next_max_id=str(i),
+                 items=[{'pk': pk, 'id': '%d_1' % pk, 'like_count': pk * 10,
+                         'user': {'pk': 1, 'username': 'usr1'}}
+                        for pk in page])
+            for i, page in enumerate([[1, 2, 2], [3]])]
+
+
+def test_feed_batches(stub_api, stub_server):
+    stub_server.responses['/api/v1/feed/tag/beach/'] = _batch_pages()
+    feed = stub_api.api_method().feed('tag_feed', 'beach', seen=seen.create())
+    batches = list(feed.iter_batches(['id', 'likes', 'user_id', 'media_id']))
+    assert [list(batch['id']) for batch in batches] == [[1, 2], [3]]
+    assert batches[0]['likes'].typecode == 'q'
+    assert list(batches[0]['likes']) == [10, 20]
+    assert list(batches[0]['user_id']) == [1, 1]
+    assert batches[0]['media_id'] == ['1_1', '2_1']
+    assert list(batches[0]) == ['id', 'likes', 'user_id', 'media_id']
+
+
+def test_feed_batch_concatenates_pages(stub_api, stub_server):
+    stub_server.responses['/api/v1/feed/tag/beach/'] = _batch_pages()
+    batch = stub_api.api_method().feed('tag_feed', 'beach').batch()
+    assert list(batch['id']) == [1, 2, 2, 3]
+    assert list(batch['view_count']) == [-1] * 4
+    assert batch['username'][0] is batch['username'][3]
+
+
+def test_feed_batch_to_numpy(stub_api, stub_server):
+    numpy = pytest.importorskip('numpy')
+    stub_server.responses['/api/v1/feed/tag/beach/'] = _batch_pages()
+    batch = stub_api.api_method().feed('tag_feed', 'beach').batch(['likes'])
+    assert numpy.sum(batch.to_numpy()['likes']) == 80
@@ -0,0 +1,48 @@
+from instatools.graph import GraphStore
+from instatools.instagram import Instagram
+
+
+def test_graph_set_operations():
+    with GraphStore() as graph:
+        followers = graph.record(1, 'followers', [1, 2, 3, 3])
+        following = graph.record(1, 'following', iter([2, 3, 4]))
+        assert graph.count(followers) == 3
+        assert sorted(graph.ids(followers)) == [1, 2, 3]
+        assert sorted(graph.intersection(followers, following)) == [2, 3]
+        assert sorted(graph.difference(followers, following)) == [1]
+        assert sorted(graph.mutual(1)) == [2, 3]
+        assert list(graph.mutual(2)) == []
+        assert graph.contains(followers, [3, 4]) == {3}
+
+
+def test_graph_keeps_latest_snapshots(tmpdir):
+    path = str(tmpdir.join('graph.db'))
+    with GraphStore(path, keep=2, chunk_size=2) as graph:
+        snapshots = [graph.record(1, 'followers', range(i, i + 5))
+                     for i in range(3)]
+    with GraphStore(path) as graph:
+        assert graph.latest(1, 'followers') == snapshots[2]
+        assert graph.latest(1, 'followers', before=1) == snapshots[1]
+        assert graph.latest(1, 'followers', before=2) is None
+        assert graph.count(snapshots[0]) == 0
+        assert sorted(graph.difference(snapshots[2], snapshots[1])) == [6]
+
+
+def test_record_graph(stub_url):
+    stub_url.responses['/api/v1/friendships/7/followers'] = [
+        {'status': 'ok', 'big_list': i < 1, 'next_max_id': str(i),
+         'users': [{'pk': pk} for pk in page]}
+        for i, page in enumerate([[1, 2], [3]])]
+    api = Instagram('usr', 'pwd', graph=GraphStore())
+    snapshot = api.record_graph('followers', 7)
+    assert snapshot == api.graph.latest(7, 'followers')
+    assert sorted(api.graph.ids(snapshot)) == [1, 2, 3]
+
+
+def test_users_update_records_graph(stub_url):
+    stub_url.responses['/api/v1/friendships/5/followers'] = [
+        {'status': 'ok', 'big_list': False, 'users': [{'pk': 1}, {'pk': 2}]}]
+    api = Instagram('usr', 'pwd', graph=GraphStore())
+    api.session.username_id = 5
+    api.followers.update()
+    assert list(api.graph.ids(api.graph.latest(5, 'followers'))) == [1, 2]
@@ -0,0 +1,138 @@
+import pickle
+import pytest
+from instatools.instagram import Instagram
+from instatools import models
+from instatools.models import ModelFactory
+
+POST = {'pk': 1, 'id': '1_2', 'like_count': 3, 'taken_at': 100,
+        'filter_type': 0, 'user': {'pk': 2, 'username': 'usr2'}}
+
+
+@pytest.fixture
+def compact_api():
+    return Instagram('usr', 'pwd', models=ModelFactory.compact())
+
+
+def test_compact_models_keep_declared_fields(compact_api):
+    post = compact_api.models.post.parse(compact_api, POST)
+    assert isinstance(post, ModelFactory.post)
+    assert isinstance(post.user, ModelFactory.user)
+    assert (post.id, post.media_id, post.likes) == (1, '1_2', 3)
+    assert post.user.username == 'usr2'
+    assert not hasattr(post, 'filter_type')
+    assert post._json is None and not hasattr(post, '__dict__')
+
+
+def test_compact_models_read_raw_json_lazily():
+    api = Instagram('usr', 'pwd', models=ModelFactory.compact(keep_raw=True))
+    post = api.models.post.parse(api, POST)
+    assert post.filter_type == 0
+    assert not hasattr(post, '__dict__')
+    with pytest.raises(AttributeError):
+        post.missing
+
+
+def test_compact_models_cache_properties(compact_api, monkeypatch):
+    calls = []
+    monkeypatch.setattr(compact_api, 'get_followers',
+                        lambda pk: calls.append(pk) or [pk], raising=False)
+    user = compact_api.models.user.parse(compact_api, POST['user'])
+    assert user.followers == [2] and user.followers == [2]
+    assert calls == [2] and not hasattr(user, '__dict__')
+
+
+def test_compact_models_pickle(compact_api):
+    post = pickle.loads(pickle.dumps(
+        compact_api.models.post.parse(compact_api, POST)))
+    assert (post.id, post.likes, post.user.username) == (1, 3, 'usr2')
+
+
+def test_compact_models_from_feeds(stub_url, feed_pages):
+    stub_url.responses['/api/v1/feed/tag/beach/'] = feed_pages([1, 2])
+    api = Instagram('usr', 'pwd', models=ModelFactory.compact())
+    posts = list(api.api_method().feed('tag_feed', 'beach'))
+    assert [type(post) for post in posts] == [api.models.post] * 2
+
+
+def test_fields_are_parsed_lazily(stub_api):
+    post = ModelFactory.post.parse(stub_api, POST)
+    assert post.__dict__ == {}
+    assert post.likes == 3 and post.__dict__['likes'] == 3
+    assert post.filter_type == 0
+    assert post.user.username == 'usr2' and post.user.id == 2
+    assert not hasattr(post, 'pk') and not hasattr(post, 'like_count')
+    assert hash(post) == 1
+
+
+def test_lazy_fields_pickle(stub_api):
+    post = pickle.loads(pickle.dumps(ModelFactory.post.parse(stub_api, POST)))
+    assert (post.id, post.media_id, post.user.id) == (1, '1_2', 2)
+
+
+def test_pickle_stores_raw_json_only(stub_api):
+    post = ModelFactory.post.parse(stub_api, POST)
+    post.likes, post.user.username
+    state = post.__getstate__()
+    assert set(state) == {'_json', 'user'}
+    assert 'user' not in state['_json'] and state['_json']['like_count'] == 3
+    assert set(state['user'].__getstate__()) == {'_json', 'followed_me_at'}
+
+
+def test_dumps_shares_users(stub_api):
+    posts = ModelFactory.post.parse_list(stub_api, [
+        dict(POST, pk=pk, user=dict(POST['user'])) for pk in range(3)])
+    loaded = models.loads(models.dumps(posts), stub_api)
+    assert [post.id for post in loaded] == [0, 1, 2]
+    assert loaded[0].user is loaded[2].user
+    assert loaded[0]._api is stub_api and loaded[0].user._api is stub_api
+    assert loaded[1].user.username == 'usr2'
+
+
+def test_users_are_shared_and_updated(stub_api):
+    post = ModelFactory.post.parse(stub_api, POST)
+    post.user.username
+    user = ModelFactory.user.parse(stub_api, {'pk': 2, 'username': 'new',
+                                              'follower_count': 5})
+    assert post.user is user
+    assert (user.username, user.n_followers) == ('new', 5)
+
+
+@pytest.mark.parametrize('models', [ModelFactory, ModelFactory.compact()])
+def test_identity_map_is_weak(models):
+    api = Instagram('usr', 'pwd', models=models)
+    user = api.models.user.parse(api, {'pk': 2, 'username': 'usr2'})
+    assert api.models.user.parse(api, {'pk': 2}) is user
+    assert user.username == 'usr2'
+    del user
+    assert len(api.identity_map) == 0
+
+
+def test_identity_map_ttl():
+    api = Instagram('usr', 'pwd', identity_ttl=0)
+    user = ModelFactory.user.parse(api, {'pk': 2})
+    assert ModelFactory.user.parse(api, {'pk': 2}) is not user
+
+
+def _candidates(*widths):
+    return {'candidates': [{'width': w, 'height': w, 'url': str(w)}
+                           for w in widths]}
+
+
+def test_image_versions(stub_api):
+    post = ModelFactory.post.parse(stub_api, dict(
+        POST, image_versions2=_candidates(640, 1080, 150)))
+    versions = post.image_versions
+    assert versions and len(versions) == 3
+    assert versions.largest['url'] == '1080' == versions[-1]['url']
+    assert versions.smallest['url'] == '150' == versions[0]['url']
+    assert versions.closest(600)['url'] == '640'
+    assert versions.children == []
+
+
+def test_carousel_image_versions(stub_api):
+    post = ModelFactory.post.parse(stub_api, dict(POST, carousel_media=[
+        {'image_versions2': _candidates(320, 640)},
+        {'image_versions2': _candidates(1080)}]))
+    assert post.image_versions.largest['url'] == '640'
+    assert [child.largest['url'] for child in post.image_versions.children] \
+        == ['640', '1080']
@@ -0,0 +1,116 @@
+from time import time
+import asyncio
+import pytest
+from instatools.ratelimit import TokenBucket
+from instatools.session import Session
+
+
+def test_bucket_starts_full():
+    bucket = TokenBucket(10, 60)
+    assert bucket.tokens == 10
+    assert bucket.next_refill is None
+
+
+def test_bucket_state_after_acquire():
+    bucket = TokenBucket(10, 10)
+    bucket.acquire(3)
+    assert bucket.tokens == 7
+    assert time() < bucket.next_refill <= time() + 1
+
+
+def test_bucket_waits_for_refill():
+    bucket = TokenBucket(100, 1)
+    bucket.acquire(100)
+    start = time()
+    with bucket:
+        pass
+    assert 0.005 < time() - start < 0.1
+
+
+def test_bucket_rejects_more_than_capacity():
+    with pytest.raises(ValueError):
+        TokenBucket(5, 1).acquire(6)
+
+
+@pytest.mark.parametrize('path, limit', [
+    ('login', 'login'), ('logout', 'login'), ('follow', 'write'),
+    ('like', 'write'), ('upload_photo', 'upload'), ('tag_feed', 'read'),
+    ('user', 'read'), (None, 'read')
+])
+def test_endpoint_limiters(path, limit):
+    session = Session('usr', 'pwd')
+    assert session.limiter_for(path) is session.limits[limit]
+
+
+def test_endpoint_classes_cover_paths():
+    assert set(Session.endpoint_classes) == set(Session.paths)
+    assert set(Session.endpoint_classes.values()) == set(Session.rate_limits)
+
+
+def test_try_acquire_does_not_wait():
+    bucket = TokenBucket(2, 3600)
+    assert bucket.try_acquire()
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert 1790 < bucket.time_until_available() <= 1800
+    assert 3590 < bucket.time_until_available(2) <= 3600
+
+
+def test_burst_limits_stored_tokens():
+    bucket = TokenBucket(100, 1, burst=5)
+    assert bucket.tokens == 5
+    assert bucket.try_acquire(5)
+    assert not bucket.try_acquire()
+
+
+def test_reservation_is_served_before_other_requests():
+    bucket = TokenBucket(10, 1)
+    reservation = bucket.reserve(15)
+    assert bucket.tokens == -5
+    assert 0.4 < reservation.time_until_ready() <= 0.5
+    assert not reservation.take()
+    assert not bucket.try_acquire()
+    reservation.ready_at = 0
+    assert reservation.take()
+    assert reservation.tokens == 14
+
+
+def test_cancelled_reservation_returns_tokens():
+    bucket = TokenBucket(10, 3600)
+    with bucket.reserve(4) as reservation:
+        assert reservation.take()
+    assert bucket.tokens == 9
+
+
+def test_acquire_async():
+    loop = asyncio.new_event_loop()
+    bucket = TokenBucket(100, 1)
+    bucket.acquire(100)
+    start = time()
+    loop.run_until_complete(bucket.acquire_async(2))
+    loop.close()
+    assert 0.01 < time() - start < 0.1
+
+
+def test_session_requests_spend_reservation():
+    session = Session('usr', 'pwd')
+    writes = session.limits['write']
+    with session.reserve('follow', 3) as reservation:
+        assert session.reservation_for('like') is reservation
+        assert session.reservation_for('user') is None
+        with session.wait_limit('unfollow'):
+            pass
+        assert reservation.tokens == 2
+        assert writes.tokens == writes.capacity - 3
+    assert session.reservation_for('like') is None
+    assert writes.tokens == writes.capacity - 1
+
+
+def test_reservations_are_per_session():
+    session, other = Session('usr', 'pwd'), Session('usr2', 'pwd')
+    with session.reserve('follow', 2) as reservation:
+        with other.reserve('user', 2) as other_reservation:
+            assert session.reservation_for('like') is reservation
+            assert session.reservation_for('user') is None
+            assert other.reservation_for('user') is other_reservation
+            assert other.reservation_for('like') is None
@@ -0,0 +1,96 @@
+from time import sleep
+import pytest
+from instatools import seen
+
+
+def test_create_seen_store():
+    assert isinstance(seen.create('lru'), seen.LRUSeen)
+    assert isinstance(seen.create('bloom'), seen.BloomSeen)
+    with pytest.raises(ValueError):
+        seen.create('set')
+
+
+def test_lru_seen_is_bounded():
+    store = seen.LRUSeen(max_items=100)
+    for i in range(1000):
+        store.add(i)
+    assert len(store) == 100
+    assert 899 not in store
+    assert all(i in store for i in range(900, 1000))
+
+
+def test_lru_seen_refreshes_ids():
+    store = seen.LRUSeen(max_items=3)
+    for i in [1, 2, 3, 1, 4]:
+        store.add(i)
+    assert 1 in store and 2 not in store
+    assert 3 in store
+    store.add(5)
+    assert 4 not in store and 1 in store and 3 in store
+
+
+def test_lru_seen_time_window():
+    store = seen.LRUSeen(max_age=0.05)
+    store.add(1)
+    assert 1 in store
+    sleep(0.06)
+    assert 1 not in store
+    store.add(2)
+    assert len(store) == 1
+
+
+def test_bloom_seen_no_false_negatives():
+    store = seen.BloomSeen(max_items=20000, error_rate=0.01)
+    for i in range(10000):
+        store.add(i)
+    assert all(i in store for i in range(10000))
+    false_positives = sum(i in store for i in range(10000, 20000))
+    assert false_positives < 300
+
+
+def test_bloom_seen_forgets_old_generations():
+    store = seen.BloomSeen(max_items=200)
+    for i in range(300):
+        store.add(i)
+    assert all(i in store for i in range(200, 300))
+    assert sum(i in store for i in range(100)) < 5
+    assert len(store) <= 200
+
+
+def test_bloom_seen_grows_with_ids():
+    store = seen.BloomSeen(max_items=1000000, error_rate=0.001)
+    assert len(store._new[0]) < 4096
+    for i in range(20000):
+        store.add(i)
+    assert all(i in store for i in range(20000))
+    false_positives = sum(i in store for i in range(20000, 120000))
+    assert false_positives < 150
+    assert sum(len(g[0]) for g in store._old + [store._new]) < 100000
+
+
+@pytest.mark.parametrize('kind', ['lru', 'bloom'])
+def test_feed_drops_seen_items(stub_api, stub_server, feed_pages, kind):
+    stub_server.responses['/api/v1/feed/tag/beach/'] = feed_pages(
+        [1, 2, 2], [2, 3], [1, 4])
+    store = seen.create(kind, max_items=1000)
+    store.add(4)
+    feed = stub_api.api_method().feed('tag_feed', 'beach', seen=store)
+    assert [post.id for post in feed] == [1, 2, 3]
+    assert all(i in store for i in [1, 2, 3, 4])
+
+
+def test_feed_without_seen_store_keeps_duplicates(stub_api, stub_server,
+                                                  feed_pages):
+    stub_server.responses['/api/v1/feed/tag/beach/'] = feed_pages(
+        [1, 2], [2])
+    feed = stub_api.api_method().feed('tag_feed', 'beach', raw=True)
+    assert [item['pk'] for item in feed] == [1, 2, 2]
+
+
+def test_feed_stops_at_page_of_seen_items(stub_api, stub_server, feed_pages):
+    # The stub keeps serving the last page as if there were more
+    pages = feed_pages([1, 2], [2, 3], [3])
+    pages[-1]['more_available'] = True
+    stub_server.responses['/api/v1/feed/tag/beach/'] = pages
+    feed = stub_api.api_method().feed('tag_feed', 'beach', seen=seen.create())
+    assert [post.id for post in feed] == [1, 2, 3]
@@ -1,5 +1,7 @@
-from time import monotonic as time
+from threading import Lock, Thread
+from time import monotonic as time, sleep
 import pytest
+from instatools.session import Session
 
 
 @pytest.mark.skip
@@ -22,11 +24,113 @@ def test_request_safely(session):
     pass
 
 
-@pytest.mark.skip
+def _slow_request(session, delay=0.05):
+    state = {'active': 0, 'peak': 0, 'calls': 0}
+    lock = Lock()
+
+    def request(method, url, **kwargs):
+        with lock:
+            state['active'] += 1
+            state['calls'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+        sleep(delay)
+        with lock:
+            state['active'] -= 1
+        return Response()
+
+    session._session.request = request
+    return state
+
+
+class Response:
+    def json(self):
+        return {'status': 'ok'}
+
+
 def test_thread_safety(session):
-    pass
+    s = Session('usr', 'pwd', max_in_flight=3)
+    state = _slow_request(s)
+    threads = [Thread(target=s.request_safely, args=('GET', s.url('user', i)))
+               for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert state['calls'] == 8
+    assert state['peak'] == 3
+
+
+def test_single_flight_shares_identical_reads(session):
+    s = Session('usr', 'pwd')
+    state = _slow_request(s, delay=0.2)
+    results = []
+
+    def get_user():
+        results.append(s.request_safely('GET', s.url('user', 1)))
+    threads = [Thread(target=get_user) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert state['calls'] == 1
+    assert s.flight_stats == {'sent': 1, 'shared': 7}
+    assert results == [{'status': 'ok'}] * 8
+    assert len(set(map(id, results))) == 8
+    s.request_safely('POST', s.url('follow', 1), endpoint='follow')
+    assert state['calls'] == 2
+    assert s.flight_stats == {'sent': 1, 'shared': 7}
 
 
-@pytest.mark.skip
 def test_request_with_hold_requests_held(session):
-    pass
+    s = Session('usr', 'pwd')
+    state = _slow_request(s, delay=0)
+    with s.hold_requests:
+        t = Thread(target=s.request_safely, args=('GET', s.url('user', 1)))
+        t.start()
+        t.join(0.1)
+        assert state['calls'] == 0
+    t.join()
+    assert state['calls'] == 1
+
+
+def test_keep_alive_reuses_connections(stub_server):
+    session = Session('usr', 'pwd')
+    for _ in range(3):
+        assert session.request('GET', stub_server.url) == {'status': 'ok'}
+    assert list(session.pool_stats.values()) == [{'hits': 2, 'misses': 1}]
+
+
+def test_keep_alive_idle_pools_are_closed(stub_server):
+    session = Session('usr', 'pwd', idle_timeout=0.01)
+    session.request('GET', stub_server.url)
+    session._adapter._last_used = {
+        k: v - 1 for k, v in session._adapter._last_used.items()}
+    session.request('GET', stub_server.url)
+    assert list(session.pool_stats.values()) == [{'hits': 0, 'misses': 2}]
+
+
+def test_keep_alive_idle_proxy_pools_are_closed(stub_server):
+    session = Session('usr', 'pwd', idle_timeout=0.01)
+    session.set_proxy(stub_server.url[len('http://'):-1])
+    session.request('GET', 'http://instagram.invalid/')
+    assert list(session._adapter._last_used) == [stub_server.url[:-1]]
+    session._adapter._last_used = {
+        k: v - 1 for k, v in session._adapter._last_used.items()}
+    session.request('GET', 'http://instagram.invalid/')
+    assert list(session.pool_stats.values()) == [{'hits': 0, 'misses': 2}]
+
+
+def test_keep_alive_after_post(stub_server):
+    session = Session('usr', 'pwd')
+    for _ in range(2):
+        assert session.request('POST', stub_server.url,
+                               data={'a': 1}) == {'status': 'ok'}
+        assert session.request('GET', stub_server.url) == {'status': 'ok'}
+    assert list(session.pool_stats.values()) == [{'hits': 3, 'misses': 1}]
+
+
+def test_connection_close_without_keep_alive(stub_server):
+    session = Session('usr', 'pwd', keep_alive=False)
+    session.request('GET', stub_server.url)
+    assert session._session.headers['Connection'] == 'close'
+    assert session.pool_stats == {}
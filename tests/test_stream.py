@@ -0,0 +1,57 @@
+import json
+import pytest
+from instatools import seen, stream
+
+DOC = {'status': 'ok', 'num_results': 3, 'more_available': True,
+       'items': [{'pk': i, 'caption': {'text': 'é' * i}, 'like_count': 1.5}
+                 for i in range(3)],
+       'next_max_id': '12345'}
+
+
+@pytest.mark.parametrize('size', [1, 3, 64, 10000])
+def test_page_decodes_items_incrementally(size):
+    body = json.dumps(DOC, indent=1).encode('utf-8')
+    chunks = [body[i:i + size] for i in range(0, len(body), size)]
+    page = stream.Page(chunks, ['items'])
+    items = iter(page)
+    assert next(items) == DOC['items'][0]
+    assert 'next_max_id' not in page.response
+    assert list(items) == DOC['items'][1:]
+    assert page.response == {k: v for k, v in DOC.items() if k != 'items'}
+
+
+def test_page_errors():
+    closed = []
+    page = stream.Page([b'{"items": [1, 2'], ['items'],
+                       close=lambda: closed.append(1))
+    with pytest.raises(json.JSONDecodeError):
+        list(page)
+    assert closed == [1]
+
+
+def test_streamed_feed(stub_api, stub_server, feed_pages):
+    pages = feed_pages([6, 5, 5], [4, 6], [2], [1])
+    stub_server.responses['/api/v1/feed/tag/beach/'] = pages
+    feed = stub_api.api_method().feed('tag_feed', 'beach', stream=True,
+                                      seen=seen.create(), since_id=3)
+    assert [post.id for post in feed] == [6, 5, 4]
+    assert stub_server.responses['/api/v1/feed/tag/beach/'] == pages[-1:]
+
+
+def test_streamed_page_items(stub_api, stub_server, feed_pages):
+    stub_server.responses['/api/v1/feed/tag/beach/'] = feed_pages([5, 4])
+    page = stub_api.api_method().feed('tag_feed', 'beach', stream=True,
+                                      raw=True).next()
+    assert [item['pk'] for item in page.items] == [5, 4]
+    assert page.has_more is False
+
+
+def test_streamed_feed_retries_error_responses(stub_api, stub_server,
+                                               feed_pages):
+    stub_api.session.sleep_on_page = 0
+    html = '<html>Please wait a few minutes</html>'
+    stub_server.responses['/api/v1/feed/tag/beach/'] = [
+        (429, 'text/html', html), (200, 'text/html', html)] + feed_pages(
+        [2, 1])
+    feed = stub_api.api_method().feed('tag_feed', 'beach', stream=True)
+    assert [post.id for post in feed] == [2, 1]
@@ -0,0 +1,72 @@
+from time import sleep
+import pytest
+from instatools.instagram import Instagram
+
+PATH = '/api/v1/friendships/None/followers'
+
+
+def _follower_pages(*pages):
+    return [{'status': 'ok', 'big_list': i < len(pages) - 1,
+             'next_max_id': str(i), 'users': [{'pk': pk} for pk in page]}
+            for i, page in enumerate(pages)]
+
+
+def _update(users, stub_server, *pages, **kwargs):
+    stub_server.responses[PATH] = _follower_pages(*pages)
+    users.__dict__.pop('current', None)
+    return [user.id for user in users.update(**kwargs)]
+
+
+def test_full_update_diffs_ids(stub_api, stub_server):
+    followers = stub_api.followers
+    _update(followers, stub_server, [1, 2])
+    assert _update(followers, stub_server, [2, 3]) == [2, 3]
+    assert list(followers.new) == [3]
+    assert list(followers.removed) == [1]
+
+
+def test_incremental_update_stops_at_known_users(stub_api, stub_server):
+    followers = stub_api.followers
+    followers.full_sync_every, followers.known_run = 3600, 2
+    _update(followers, stub_server, [5, 4], [3, 2, 1])
+
+    pages = _follower_pages([7, 6, 5], [4, 3], [2, 1])
+    stub_server.responses[PATH] = pages
+    assert [u.id for u in followers.update()] == [7, 6, 5, 4, 3, 2, 1]
+    assert list(followers.new) == [7, 6] and not followers.removed
+    assert stub_server.responses[PATH] == pages[-1:]
+
+    assert _update(followers, stub_server, [7, 5], full=True) == [7, 5]
+    assert list(followers.removed) == [6, 4, 3, 2, 1]
+
+
+def test_snapshot(stub_url, tmpdir):
+    path = str(tmpdir.join('followers'))
+    api = Instagram('usr', 'pwd')
+    api.followers.snapshot = path
+    _update(api.followers, stub_url, [2, 1])
+
+    api = Instagram('usr', 'pwd')
+    api.followers.snapshot, api.followers.full_sync_every = path, 3600
+    assert _update(api.followers, stub_url, [3, 2, 1]) == [3, 2, 1]
+    assert list(api.followers.new) == [3]
+
+
+def test_reconcile_in_background(stub_api, stub_server):
+    stub_server.responses[PATH] = _follower_pages([1, 2])
+    followers = stub_api.followers
+    thread = followers.reconcile(every=3600)
+    for _ in range(100):
+        if followers.all:
+            break
+        sleep(0.01)
+    followers.stop()
+    thread.join(1)
+    assert list(followers.all) == [1, 2] and not thread.is_alive()
+
+
+def test_reconcile_needs_an_interval(stub_api):
+    with pytest.raises(ValueError):
+        stub_api.followers.reconcile()
+    with pytest.raises(ValueError):
+        stub_api.followers.reconcile(every=-1)